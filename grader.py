@@ -54,6 +54,33 @@ if __name__ == '__main__':
    # Run convex combinations tests
    scores['Convex combinations'] = runTests(tests.convexCombo, "tests/convexcombo/")
    
+   # Run network file tests
+   scores['Network files'] = runTests(tests.networkFile, "tests/network/")
+   
+   # Run all-departure-time TDSP tests
+   scores['All-departure TDSP'] = runTests(tests.allDepartureTDSP, "tests/alldeparture/")
+   
+   # Run parallel shortest path tests
+   scores['Parallel shortest paths'] = runTests(tests.parallelShortestPaths, "tests/parallel/")
+   
+   # Run step size rule tests
+   scores['Step sizes'] = runTests(tests.stepSizeRule, "tests/stepsize/")
+   
+   # Run path swapping tests
+   scores['Path swapping'] = runTests(tests.pathSwapping, "tests/pathswap/")
+   
+   # Run warm start tests
+   scores['Warm start'] = runTests(tests.warmStart, "tests/warmstart/")
+   
+   # Run binary network and result file tests
+   scores['Binary files'] = runTests(tests.networkArchive, "tests/archive/")
+   
+   # Run node model tests
+   scores['Node models'] = runTests(tests.nodeTransitionFlows, "tests/node/")
+   
+   # Run network loading tests
+   scores['Network loading'] = runTests(tests.networkLoading, "tests/loading/")
+   
    displayScores(scores)
    sys.exit()
    
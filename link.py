@@ -1,5 +1,91 @@
+import numpy
+
 from units import *
 
+class CumulativeCounts:
+   """
+   Compact storage for the cumulative vehicle counts at one end of a link, disaggregated by path.  Paths are
+   identified by their integer IDs in the network's PathRegistry.  Each path seen on the link is assigned a
+   column through the pathIndex table, and counts are kept in a preallocated NumPy matrix with one row per
+   time step.  Row 0 holds the initial (empty) counts, and each call to append
+   fills in the next row.  Indexing with a time step returns a dictionary whose keys are path IDs, so existing
+   code can treat this object like the list of dictionaries it replaces.
+
+   The totals array is maintained alongside the matrix and holds the cumulative count summed over all paths,
+   so aggregate counts can be read without touching the per-path data.
+   """
+
+   def __init__(self, numTimes = 1, numPaths = 4):
+      self.pathIndex = dict() # keys are path IDs, values are column indices
+      self.paths = list()     # path ID stored in each column
+      self.counts = numpy.zeros((max(numTimes, 1), max(numPaths, 1)))
+      self.totals = numpy.zeros(max(numTimes, 1))
+      self.length = 1
+
+   def __len__(self):
+      return self.length
+
+   def __getitem__(self, t):
+      t = self.checkIndex(t)
+      return dict(zip(self.paths, self.counts[t, :len(self.paths)].tolist()))
+
+   def checkIndex(self, t):
+      """
+      Converts negative indices and raises IndexError for rows which have not been filled in yet.
+      """
+      if t < 0: t += self.length
+      if t < 0 or t >= self.length:
+         raise IndexError("cumulative count index out of range")
+      return t
+
+   def column(self, path):
+      """
+      Returns the column used for a path, adding one (and growing the count matrix if needed) for new paths.
+      """
+      try:
+         return self.pathIndex[path]
+      except KeyError:
+         if len(self.paths) == self.counts.shape[1]:
+            self.counts = numpy.hstack((self.counts, numpy.zeros(self.counts.shape)))
+         self.pathIndex[path] = len(self.paths)
+         self.paths.append(path)
+         return self.pathIndex[path]
+
+   def append(self, pathFlows):
+      """
+      Adds a row equal to the previous cumulative counts plus the flows in pathFlows (a dictionary with path
+      IDs as keys).
+      """
+      columns = [self.column(path) for path in pathFlows or []]
+      if self.length == self.counts.shape[0]:
+         self.counts = numpy.vstack((self.counts, numpy.zeros(self.counts.shape)))
+         self.totals = numpy.concatenate((self.totals, numpy.zeros(self.totals.shape)))
+      t = self.length
+      self.counts[t] = self.counts[t - 1]
+      self.totals[t] = self.totals[t - 1]
+      if len(columns) > 0:
+         flows = list(pathFlows.values())
+         self.counts[t, columns] += flows
+         self.totals[t] += sum(flows)
+      self.length += 1
+
+   def total(self, t):
+      """
+      Returns the cumulative count at time t, summed over all paths.
+      """
+      return self.totals[self.checkIndex(t)].item()
+
+   def difference(self, startTime, endTime):
+      """
+      Returns the change in cumulative counts between startTime and endTime as a dictionary with path IDs as
+      keys.  Paths with no change are omitted.
+      """
+      startTime = self.checkIndex(startTime)
+      endTime = self.checkIndex(endTime)
+      numPaths = len(self.paths)
+      change = self.counts[endTime, :numPaths] - self.counts[startTime, :numPaths]
+      return {self.paths[c] : change[c].item() for c in numpy.flatnonzero(change)}
+
 class Link:
 
    def __init__(self, timestep, freeFlowSpeed, backwardWaveSpeed, jamDensity, length, capacity, ID = None):
@@ -31,11 +117,16 @@ class Link:
       self.freeFlowTime = int((self.length/self.freeFlowSpeed + timestep - 1) / timestep) 
       self.backwardWaveTime = int((self.length/self.backwardWaveSpeed + timestep - 1) / timestep) 
 
-      # initialize dictionaries and counts
-      self.upstreamPathCount = list()
-      self.downstreamPathCount = list()
-      self.upstreamPathCount.append(dict())
-      self.downstreamPathCount.append(dict())
+      # initialize counts; subclasses set up the rest of their state after this constructor returns
+      Link.resetCounts(self)
+
+   def resetCounts(self, timeHorizon = 0):
+      """
+      Clears the cumulative counts at both ends of the link.  Passing the network time horizon preallocates
+      enough rows for a full network loading.
+      """
+      self.upstreamPathCount = CumulativeCounts(timeHorizon + 1)
+      self.downstreamPathCount = CumulativeCounts(timeHorizon + 1)
 
    def calculateSendingFlow(self, t):
       pass
@@ -56,10 +147,7 @@ class Link:
       """
       if t < 0:
          return 0
-      count = 0
-      for path in self.upstreamPathCount[t].keys():
-         count += self.upstreamPathCount[t][path]
-      return count
+      return self.upstreamPathCount.total(t)
 
    def downstreamCount(self, t):
       """
@@ -67,10 +155,7 @@ class Link:
       """
       if t < 0:
          return 0
-      count = 0
-      for path in self.downstreamPathCount[t].keys():
-         count += self.downstreamPathCount[t][path]
-      return count
+      return self.downstreamPathCount.total(t)
 
    def vehiclesOnLink(self, t):
       """
@@ -82,42 +167,22 @@ class Link:
       """
       Adds flow to the upstream end of a link; based on pathFlows.  Tracks inflows disaggregated by path.  Extends upstream array. 
       """
-      self.upstreamPathCount.append(dict())
-      # First copy previous flows
-      for path in self.upstreamPathCount[-2].keys():
-         self.upstreamPathCount[-1][path] = self.upstreamPathCount[-2][path]
-
-      # Then add new inflows
-      for path in pathFlows or []:
-         self.upstreamPathCount[-1][path] = pathFlows[path] + self.upstreamPathCount[-1].setdefault(path, 0)
+      self.upstreamPathCount.append(pathFlows)
 
    def flowOut(self, pathFlows):
       """
       Removes flow from the downstream end of a link; based on pathFlows.  Tracks outflows disaggregated by path. Extends downstream array.
       """
-      self.downstreamPathCount.append(dict())
-      
-      # First copy previous flows
-      for path in self.downstreamPathCount[-2].keys():
-         self.downstreamPathCount[-1][path] = self.downstreamPathCount[-2][path]
-
-      # Then add new outflows
-      for path in pathFlows or []:
-         self.downstreamPathCount[-1][path] = pathFlows[path] + self.downstreamPathCount[-1].setdefault(path, 0)
+      self.downstreamPathCount.append(pathFlows)
 
    def getFlowComposition(self, startTime, endTime):
       """
       Returns the total number of vehicles entering a link between startTime and endTime (inclusive), disaggregated by path.
-      These values are returned in a dictionary with paths as keys.
+      These values are returned in a dictionary with path IDs as keys.
       """
       startTime = int(startTime)
       endTime = min(int(endTime), startTime + 1)
-            
-      pathCounts = dict()
-      totalFlow = 0
-      for path in set(self.upstreamPathCount[startTime].keys()) | set(self.upstreamPathCount[endTime].keys()):
-         pathCounts[path] = self.upstreamPathCount[endTime].setdefault(path, 0) - self.upstreamPathCount[startTime].setdefault(path, 0)
-      return pathCounts
+      return self.upstreamPathCount.difference(startTime, endTime)
       
    def getEntryTime(self, vehicle, roundUp = False, tolerance = 0.01):
       """
@@ -128,19 +193,17 @@ class Link:
       will simply return all zeroes, which is not useful for getting turning proportions.)
       
       The tolerance argument is used to control for numerical/floating point errors, and can be adjusted as necessary.
+
+      Cumulative counts never decrease, so both cases are answered by bisection over the upstream totals.
       """   
+      counts = self.upstreamPathCount.totals[:len(self.upstreamPathCount)]
       # round down when getting first time; round up when getting second time
       if roundUp == True:
-         t = 0
-         while self.upstreamCount(t) <= vehicle - tolerance:
-            t += 1
-            if t == len(self.upstreamPathCount): return len(self.upstreamPathCount)
+         # first time whose count exceeds vehicle - tolerance (or the number of times if there is none)
+         return int(numpy.searchsorted(counts, vehicle - tolerance, side = 'right'))
       else:
-         t = len(self.upstreamPathCount) - 1
-         while self.upstreamCount(t) >= vehicle + tolerance:
-            t -= 1
-            if t == 0: return 0
-      return t
+         # last time whose count is below vehicle + tolerance, but never earlier than time 0
+         return max(0, int(numpy.searchsorted(counts, vehicle + tolerance, side = 'left')) - 1)
       
    def calculateTravelTime(self, t):
       pass
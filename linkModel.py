@@ -1,3 +1,6 @@
+from copy import copy
+import numpy
+
 from link import Link
 from units import *
 
@@ -42,45 +45,161 @@ class SpatialQueueLink(Link):
    def calculateReceivingFlow(self, t):
       return max(0, min(self.maxVehicles - self.vehiclesOnLink(t), self.upstreamCapacity))
 
-class Cell:
-   
-   def __init__(self, capacity, maxVehicles, delta):
-      self.capacity = capacity
-      self.maxVehicles = maxVehicles
-      self.delta = delta
-      self.vehicles = 0
-            
+# Driver reaction time used to derive CTM link parameters from the vehicle mix
+REACTION_TIME = 1.25 * SECONDS
+
+class VehicleClass:
+   """
+   A vehicle class for multi-class CTM links.  length must be provided in feet; share is the default
+   proportion of demand belonging to this class.
+   """
+
+   def __init__(self, name, length, share):
+      self.name = name
+      self.length = length * FEET
+      self.share = share
+
+# Without class data in the network file, all demand is buses
+DEFAULT_VEHICLE_CLASSES = [VehicleClass('car', 15.75, 0), VehicleClass('bus', 40, 1)]
+
+def classShares(vehicleClasses):
+   """
+   Returns an array with the default share of each vehicle class, normalized to sum to one.
+   """
+   shares = numpy.array([vehicleClass.share for vehicleClass in vehicleClasses], dtype = float)
+   return shares / shares.sum()
+
+class Cells:
+   """
+   Stores all cells of a CTM link as contiguous NumPy arrays.  vehicles has one row per cell and one column per
+   vehicle class.  capacity, maxVehicles, and delta (the ratio of backward wave speed to free-flow speed) have
+   one element per cell, and are recomputed from each cell's current class mix by updateParameters.  The
+   free-flow speed and length of each cell are also stored per cell, so cells from different links can be
+   packed together (see CellBatch).
+   """
+
+   # Per-cell arrays; these are sliced and packed together by slice and CellBatch
+   ARRAYS = ('vehicles', 'freeFlowSpeed', 'cellLength', 'capacity', 'maxVehicles', 'delta')
+
+   def __init__(self, numCells, freeFlowSpeed, cellLength, vehicleClasses):
+      self.classLengths = numpy.array([vehicleClass.length for vehicleClass in vehicleClasses], dtype = float)
+      self.defaultShares = classShares(vehicleClasses)
+      self.vehicles = numpy.zeros((numCells, len(vehicleClasses)))
+      self.freeFlowSpeed = numpy.full(numCells, float(freeFlowSpeed))
+      self.cellLength = numpy.full(numCells, float(cellLength))
+      self.capacity = numpy.zeros(numCells)
+      self.maxVehicles = numpy.zeros(numCells)
+      self.delta = numpy.zeros(numCells)
+      self.updateParameters()
+
+   def __len__(self):
+      return len(self.vehicles)
+
+   def slice(self, start, end):
+      """
+      Returns a Cells object whose arrays are views of cells start through end - 1 of this one, so changes
+      made through either object are seen by both.
+      """
+      view = copy(self)
+      for name in Cells.ARRAYS:
+         setattr(view, name, getattr(self, name)[start:end])
+      return view
+
+   def totalVehicles(self):
+      return self.vehicles.sum(axis = 1)
+
+   def updateParameters(self):
+      """
+      Recomputes the capacity, maximum number of vehicles, and delta of every cell from the average vehicle
+      length of its current class mix.  Empty cells use the default mix.  Arrays are updated in place so
+      views created by slice stay valid.
+      """
+      totalVehicles = self.totalVehicles()
+      averageLength = numpy.full(len(totalVehicles), self.defaultShares.dot(self.classLengths))
+      occupied = totalVehicles > 0
+      averageLength[occupied] = self.vehicles[occupied].dot(self.classLengths) / totalVehicles[occupied]
+
+      spacing = self.freeFlowSpeed * REACTION_TIME + averageLength
+      self.capacity[:] = self.freeFlowSpeed / spacing
+      self.maxVehicles[:] = self.cellLength / spacing
+      self.delta[:] = averageLength / REACTION_TIME / self.freeFlowSpeed
+
    def calculateSendingFlow(self):
-      return min(self.vehicles, self.capacity)
+      return numpy.minimum(self.totalVehicles(), self.capacity)
 
    def calculateReceivingFlow(self):
-      return min(self.delta * (self.maxVehicles - self.vehicles), self.capacity)
-      
-   def removeVehicles(self, numVehicles):
-      self.vehicles -= numVehicles
-      
-   def addVehicles(self, numVehicles):
-      self.vehicles += numVehicles
+      return numpy.minimum(self.delta * (self.maxVehicles - self.totalVehicles()), self.capacity)
+
+   def moveVehicles(self, fromCells, toCells):
+      """
+      Moves flow from each of fromCells to the matching element of toCells (slices or index arrays) for one
+      time step, based on the sending flow of the upstream cell and the receiving flow of the downstream cell.
+      Each class moves in proportion to its share of the upstream cell.
+      """
+      totalVehicles = self.totalVehicles()[fromCells]
+      cellTransitionFlow = numpy.minimum(self.calculateSendingFlow()[fromCells], self.calculateReceivingFlow()[toCells])
+      movingFraction = numpy.divide(cellTransitionFlow, totalVehicles, out = numpy.zeros(len(totalVehicles)), where = totalVehicles > 0)
+      classTransitionFlow = self.vehicles[fromCells] * movingFraction[:, numpy.newaxis]
+      self.vehicles[fromCells] -= classTransitionFlow
+      self.vehicles[toCells] += classTransitionFlow
+
+class CellBatch:
+   """
+   Packs the cells of several CTM links into one set of Cells arrays, with offsets marking where each link's
+   cells start, so the link updates for all of them can be done in one vectorized pass per time step.  The
+   links' own cells are replaced by views into the packed arrays, so flowIn and flowOut keep working as usual.
+   All links must use the same vehicle classes.
+   """
+
+   def __init__(self, links):
+      self.links = list(links)
+      self.offsets = numpy.cumsum([0] + [len(link.cells) for link in self.links])
+      self.cells = copy(self.links[0].cells)
+      for name in Cells.ARRAYS:
+         setattr(self.cells, name, numpy.concatenate([getattr(link.cells, name) for link in self.links]))
+      for i, link in enumerate(self.links):
+         link.cells = self.cells.slice(self.offsets[i], self.offsets[i + 1])
+
+      self.firstCells = self.offsets[:-1]
+      self.lastCells = self.offsets[1:] - 1
+      # Interior transitions run from every cell except the last one of each link
+      interior = numpy.ones(self.offsets[-1], dtype = bool)
+      interior[self.lastCells] = False
+      self.interiorCells = numpy.flatnonzero(interior)
+
+   def linkUpdate(self, t):
+      """
+      Batched equivalent of CellTransmissionModelLink.linkUpdate: moves flow between interior cells of every
+      link, and returns a list of (link, sendingFlow, receivingFlow) tuples based on the initial cell values.
+      """
+      self.cells.updateParameters()
+      sendingFlow = self.cells.calculateSendingFlow()[self.lastCells].tolist()
+      receivingFlow = self.cells.calculateReceivingFlow()[self.firstCells].tolist()
+      self.cells.moveVehicles(self.interiorCells, self.interiorCells + 1)
+      return list(zip(self.links, sendingFlow, receivingFlow))
 
 class CellTransmissionModelLink(Link):
+   """
+   Multi-class CTM link.  Each cell tracks vehicles by class, and its capacity, jam density, and backward wave
+   speed are derived each time step from the average vehicle length of its current mix.  Inflows are split into
+   classes using pathClassShares, a dictionary whose keys are path IDs and whose values are arrays of class shares
+   (set up by the Network); paths not listed there use the default class shares.
+   """
 
-   def __init__(self, timestep, freeFlowSpeed, backwardWaveSpeed, jamDensity, length, capacity, ID = None):
+   def __init__(self, timestep, freeFlowSpeed, backwardWaveSpeed, jamDensity, length, capacity, ID = None, vehicleClasses = None):
       Link.__init__(self, timestep, freeFlowSpeed, backwardWaveSpeed, jamDensity, length, capacity, ID)
-      # Create a cell for each timestep needed to traverse the link
-      self.cells = list()
+      if vehicleClasses == None:
+         vehicleClasses = DEFAULT_VEHICLE_CLASSES
+      self.vehicleClasses = list(vehicleClasses)
+      self.pathClassShares = dict()
       
-      # set proportion of cars
-      p = 0
-        
-      # set vehicle lengths (in feet) and driver reaction time (in seconds)
-      busLength = 40
-      carLength = 15.75
-      reactionTime = 1.25
+      # average vehicle length (in feet) for the default class mix
+      averageLength = classShares(self.vehicleClasses).dot([vehicleClass.length for vehicleClass in self.vehicleClasses])
       
       # override backward wave speed, jam density, and capacity given derived equations
-      self.backwardWaveSpeed = ((p * carLength + (1 - p) * busLength) / reactionTime)
-      self.jamDensity = 1 / ((self.freeFlowSpeed * reactionTime + p * carLength + (1 - p) * busLength) )
-      self.capacity = self.freeFlowSpeed / (self.freeFlowSpeed * reactionTime + p * carLength + (1 - p) * busLength) 
+      self.backwardWaveSpeed = averageLength / REACTION_TIME
+      self.jamDensity = 1 / (self.freeFlowSpeed * REACTION_TIME + averageLength)
+      self.capacity = self.freeFlowSpeed / (self.freeFlowSpeed * REACTION_TIME + averageLength)
       
       # show link properties that were changed
       print("Link: ",self.ID)
@@ -89,44 +208,44 @@ class CellTransmissionModelLink(Link):
       print("backwardWaveSpeed (ft/s): ", self.backwardWaveSpeed)
       print("----------------")
       
-      for c in range(self.freeFlowTime):
-         newCell = Cell(self.capacity, self.jamDensity * self.length / self.freeFlowTime, self.backwardWaveSpeed / self.freeFlowSpeed)
-         self.cells.append(newCell)
+      # Create a cell for each timestep needed to traverse the link
+      self.cells = Cells(self.freeFlowTime, self.freeFlowSpeed, self.length / self.freeFlowTime, self.vehicleClasses)
+
+   def resetCounts(self, timeHorizon = 0):
+      Link.resetCounts(self, timeHorizon)
+      # Empty the cells in place, since they may be views into a CellBatch
+      self.cells.vehicles[:] = 0
          
    def calculateSendingFlow(self, t):
-      return self.cells[-1].calculateSendingFlow()
+      return min(self.cells.vehicles[-1].sum(), self.cells.capacity[-1]).item()
 
    def calculateReceivingFlow(self, t):
-      return self.cells[0].calculateReceivingFlow()
+      return min(self.cells.delta[0] * (self.cells.maxVehicles[0] - self.cells.vehicles[0].sum()), self.cells.capacity[0]).item()
 
    def linkUpdate(self, t):
-      # Calculate sending/receiving flows based on initial values
+      # Update cell parameters for the current class mix, then calculate sending/receiving flows
+      self.cells.updateParameters()
       sendingFlow = self.calculateSendingFlow(t)
       receivingFlow = self.calculateReceivingFlow(t)
 
-      # Now calculate flow moving between cells
-      cellTransitionFlow = list()
-      for c in range(0, self.freeFlowTime-1):
-         cellSendingFlow = self.cells[c].calculateSendingFlow()
-         cellReceivingFlow = self.cells[c+1].calculateReceivingFlow()
-         cellTransitionFlow.append(min(cellSendingFlow, cellReceivingFlow))
-      
-      # Now propagate flow between cells
-      for c in range(0, self.freeFlowTime-1):
-         self.cells[c].removeVehicles(cellTransitionFlow[c])
-         self.cells[c+1].addVehicles(cellTransitionFlow[c])
+      # Now calculate and propagate flow moving between cells
+      self.cells.moveVehicles(slice(0, len(self.cells) - 1), slice(1, len(self.cells)))
          
       return (sendingFlow, receivingFlow)
 
    def flowIn(self, pathFlows):
       Link.flowIn(self, pathFlows)
-      totalIn = sum(pathFlows.values())
-      self.cells[0].addVehicles(totalIn)
+      for path in pathFlows:
+         self.cells.vehicles[0] += pathFlows[path] * self.pathClassShares.get(path, self.cells.defaultShares)
    
    def flowOut(self, pathFlows):   
       Link.flowOut(self, pathFlows)
       totalOut = sum(pathFlows.values())
-      self.cells[len(self.cells)-1].removeVehicles(totalOut)
+      # Vehicles leave the last cell in proportion to its class mix
+      lastCell = self.cells.vehicles[-1]
+      totalVehicles = lastCell.sum()
+      if totalVehicles > 0:
+         lastCell -= totalOut * lastCell / totalVehicles
 
 class LinkTransmissionModelLink(Link):
 
@@ -1,8 +1,14 @@
+import concurrent.futures
 from copy import copy
+import heapq
+from multiprocessing import shared_memory
 import node
 import nodeModel
 import link
 import linkModel
+import numpy
+import pathMatrix
+import stepSize
 import sys
 import traceback
 import utils
@@ -12,19 +18,260 @@ INFINITY = 99999
 NO_PATH = 'N/A'
 EXIT_FAILURE = -1
 IS_MISSING = -1
+PROGRESS_INTERVAL = 10000 # readNetworkFile reports progress after this many OD pairs
+
+# Path flow update methods used by Network.DTA
+CONVEX_COMBINATIONS = 'convex combinations'
+PATH_SWAPPING = 'path swapping'
+
+class ShortestPathLabels:
+   """
+   Cost, backlink and finalized labels for timeDependentDijkstra, allocated once so that repeated searches
+   over the same network can reuse them.  touched lists the nodes whose labels the last search changed, and
+   only these are reset before the next search.
+   """
+   def __init__(self, numNodes):
+      self.cost = [INFINITY] * numNodes
+      self.backlink = [NO_PATH] * numNodes
+      self.finalizedNodes = [False] * numNodes
+      self.touched = list()
+
+   def reset(self):
+      for i in self.touched:
+         self.cost[i] = INFINITY
+         self.backlink[i] = NO_PATH
+         self.finalizedNodes[i] = False
+      self.touched = list()
+
+def timeDependentDijkstra(numNodes, forwardStar, links, origin, departureTime, labels = None):
+   """
+   One-to-all time-dependent shortest path search used by Network.TDSP and by the parallel
+   shortest path workers.  forwardStar lists the IDs of links leaving each node, and links maps
+   these IDs to objects with head and travelTime attributes.  Returns the (cost, backlink) labels.
+
+   If labels (a ShortestPathLabels object) is given, its lists are reset and reused instead of
+   allocating new ones, so the labels returned are only valid until the next search using them.
+   """
+   # initialize the cost and backlink labels
+   if labels == None:
+      labels = ShortestPathLabels(numNodes)
+   else:
+      labels.reset()
+   cost = labels.cost
+   backlink = labels.backlink
+   finalizedNodes = labels.finalizedNodes
+   touched = labels.touched
+   
+   # initialize the cost of the origin
+   cost[origin] = departureTime
+   touched.append(origin)
+   
+   # unfinalized nodes are kept in a binary heap ordered by (cost, node ID), so ties are broken in favor of
+   # the lowest node ID.  Entries left behind when a label improves are skipped when popped.
+   heap = [(departureTime, origin)]
+   while len(heap) > 0:
+      minCost, minNode = heapq.heappop(heap)
+      if finalizedNodes[minNode] or minCost > cost[minNode]:
+         continue
+      finalizedNodes[minNode] = True
+
+      # for all the links coming from the minNode, perform the algorithm calculations
+      for ij in forwardStar[minNode]:
+         head = links[ij].head
+         newCost = minCost + links[ij].travelTime[minCost]
+         if newCost < cost[head]:
+            if cost[head] == INFINITY: touched.append(head)
+            cost[head] = newCost
+            backlink[head] = ij
+            heapq.heappush(heap, (newCost, head))
+
+   return (cost, backlink)
+
+def tracePath(links, origin, destination, backlink):
+   """
+   Reconstructs the path from origin to destination given by a list of backlink labels,
+   returning it as a tuple of link IDs.
+   """
+   curNode = destination
+   tempPath = list()
+   while curNode != origin:
+      tempPath.append(backlink[curNode])
+      curNode = links[backlink[curNode]].tail
+   return tuple(reversed(tempPath))
+
+def destinationPaths(links, origin, departureTime, destinations, labels):
+   """
+   Extracts the paths to several destinations from one set of TDSP (cost, backlink) labels.  Returns
+   a dictionary whose keys are destinations and whose values are (path, travel time) tuples; the path
+   is None if the destination was not reached.
+   """
+   cost, backlink = labels
+   paths = dict()
+   for destination in destinations:
+      if backlink[destination] == NO_PATH:
+         paths[destination] = (None, INFINITY)
+      else:
+         paths[destination] = (tracePath(links, origin, destination, backlink), cost[destination] - departureTime)
+   return paths
+
+class LinkTravelTimes:
+   """
+   Lightweight stand-in for a Link in shortest path workers, holding only its end nodes and travel times.
+   """
+   def __init__(self, tail, head, travelTime):
+      self.tail = tail
+      self.head = head
+      self.travelTime = travelTime
+
+workerLinks = None # (shared block name, version, links) last read by this shortest path worker process
+
+def originShortestPaths(sharedName, version, shape, numNodes, forwardStar, linkIDs, tails, heads, tasks):
+   """
+   Worker for parallel shortest path computation.  Link travel times are read from the shared memory
+   block sharedName, holding an integer array of the given shape with one row per link (in the order of
+   linkIDs).  tasks is a list of (origin, departure time, destinations) tuples; the result is a list of
+   ((origin, departure time), paths) tuples, where paths is the dictionary returned by destinationPaths.
+
+   The block is rewritten with new travel times for each search, with a new version number.  Each worker
+   process converts the travel times to lists once per version and keeps them in workerLinks for the
+   other shards it is given.
+   """
+   global workerLinks
+   if workerLinks == None or workerLinks[:2] != (sharedName, version):
+      sharedTravelTimes = shared_memory.SharedMemory(name = sharedName)
+      travelTime = numpy.ndarray(shape, dtype = numpy.int64, buffer = sharedTravelTimes.buf).tolist()
+      sharedTravelTimes.close()
+      workerLinks = (sharedName, version, {ij : LinkTravelTimes(tails[k], heads[k], travelTime[k]) for k, ij in enumerate(linkIDs)})
+   links = workerLinks[2]
+   
+   results = list()
+   labels = ShortestPathLabels(numNodes)
+   for origin, t, destinations in tasks:
+      timeDependentDijkstra(numNodes, forwardStar, links, origin, t, labels)
+      results.append(((origin, t), destinationPaths(links, origin, t, destinations, (labels.cost, labels.backlink))))
+   return results
+   
+def loadResults(fileName):
+   """
+   Reads a results file written by Network.saveResults, returning a dictionary of NumPy arrays with keys
+   timestep, linkIDs, upstreamCounts, downstreamCounts, travelTimes, paths (link IDs joined by commas),
+   pathFlows and pathTravelTimes.  Rows of the count and travel time arrays follow linkIDs, and rows of the
+   path arrays follow paths.
+   """
+   with numpy.load(fileName, allow_pickle = False) as archive:
+      return {key : archive[key] for key in archive.files}
+
+class LoadingPlan:
+   """
+   Everything loadNetwork needs to know about the network topology, worked out once when the network is
+   finalized so the loading loop only does numeric work.  Links are numbered in the order of network.links:
+   
+      links ------------ list of Link objects, indexed by link number
+      linkIndex -------- dictionary whose keys are link IDs and whose values are link numbers
+      sendingFlow ------ list with one element per link, reused every time step to hold sending flows
+      receivingFlow ---- the same as sendingFlow, for receiving flows
+      junctions -------- list of (node, inLinks, outLinks, inIndices, outIndices, nodeSendingFlow,
+                         nodeReceivingFlow) tuples for every node which is not a centroid; the last two are
+                         dictionaries keyed by Link objects, refilled every time step and passed to
+                         calculateTransitionFlows
+      originConnectors - list of (link ID, Link object) pairs for links leaving centroids
+      destinations ----- list of (node, inLinks, inIndices, nodeSendingFlow) tuples for destination nodes
+   """
+
+   def __init__(self, network):
+      linkIDs = list(network.links)
+      self.links = [network.links[ij] for ij in linkIDs]
+      self.linkIndex = {ij : k for k, ij in enumerate(linkIDs)}
+      self.sendingFlow = [0] * len(linkIDs)
+      self.receivingFlow = [0] * len(linkIDs)
+      
+      self.junctions = list()
+      self.destinations = list()
+      for i in range(network.numNodes):
+         currentNode = network.nodes[i]
+         if isinstance(currentNode, nodeModel.OriginNode): continue
+         inIndices = [self.linkIndex[ij] for ij in network.reverseStar[i]]
+         outIndices = [self.linkIndex[ij] for ij in network.forwardStar[i]]
+         inLinks = [self.links[k] for k in inIndices]
+         outLinks = [self.links[k] for k in outIndices]
+         if isinstance(currentNode, nodeModel.DestinationNode):
+            self.destinations.append((currentNode, inLinks, inIndices, dict()))
+            continue
+         self.junctions.append((currentNode, inLinks, outLinks, inIndices, outIndices, dict(), dict()))
+         
+      self.originConnectors = [(ij, network.links[ij]) for ij in linkIDs
+                               if isinstance(network.nodes[network.links[ij].tail], nodeModel.OriginNode)]
+
+class DemandRates:
+   """
+   Demand for one OD pair, stored compactly as arrays of the time steps with nonzero demand (times) and
+   the demand at those times (values).  Indexing with a time step returns the demand at that time (0 if
+   there is none), and iterating gives the demand at every time step, so this object can be used in place
+   of a list with one element per time step.
+
+   demandRates normally lists the demand at every time step.  If times is given, demandRates instead lists
+   the demand at just those time steps (in increasing order), and timeHorizon gives the number of time
+   steps; this is how binary network files store demand.
+   """
+
+   def __init__(self, demandRates, times = None, timeHorizon = None):
+      demandRates = numpy.asarray(demandRates)
+      if times is None:
+         self.timeHorizon = len(demandRates)
+         self.times = numpy.flatnonzero(demandRates).astype(numpy.int32)
+         self.values = demandRates[self.times]
+      else:
+         nonzero = demandRates != 0
+         self.timeHorizon = timeHorizon
+         self.times = numpy.asarray(times, dtype = numpy.int32)[nonzero]
+         self.values = demandRates[nonzero]
+
+   def __len__(self):
+      return self.timeHorizon
+
+   def __getitem__(self, t):
+      if t < 0: t += self.timeHorizon
+      if t < 0 or t >= self.timeHorizon:
+         raise IndexError("demand index out of range")
+      k = numpy.searchsorted(self.times, t)
+      if k < len(self.times) and self.times[k] == t:
+         return self.values[k].item()
+      return 0
+
+   def __iter__(self):
+      return iter(self.dense().tolist())
+
+   def dense(self):
+      """
+      Returns the demand at every time step as a NumPy array.
+      """
+      demandRates = numpy.zeros(self.timeHorizon, dtype = self.values.dtype)
+      demandRates[self.times] = self.values
+      return demandRates
+
+   def departureTimes(self):
+      """
+      Returns a list of the time steps with positive demand, in increasing order.
+      """
+      return self.times[self.values > 0].tolist()
+
+   def total(self):
+      return self.values.sum().item()
 
 class OD:
    """
-   The OD class has four attributes: the origin node, the destination node,
-   a list of the total demand between the origin and destination (with one element per
-   time interval), and a list of paths which connect the origin and destination.
-   This can either be an enumeration of all paths (which the Network class currently
-   implements) or a subset of paths used for assignment.
+   The OD class has five attributes: the origin node, the destination node,
+   the total demand between the origin and destination (a DemandRates object, indexed by
+   time interval), the share of this demand in each vehicle class, and a list of paths
+   which connect the origin and destination.  The paths can either be an enumeration of
+   all paths (which the Network class currently implements) or a subset of paths used
+   for assignment.
    """
-   def __init__(self, origin, destination, demandRates):
+   def __init__(self, origin, destination, demandRates, classShares):
       self.origin = origin
       self.destination = destination
-      self.demandRates = list(demandRates)
+      self.demandRates = demandRates if isinstance(demandRates, DemandRates) else DemandRates(demandRates)
+      self.classShares = classShares
       self.paths = list()
    
 class Network:
@@ -37,133 +284,152 @@ class Network:
                          whose values are Link objects
       nodes ------------ a list of Node objects
       ODs -------------- a list of OD objects
+      vehicleClasses --- a list of VehicleClass objects used by multi-class CTM links
       forwardStar ------ a list with one element per node; each element of this list is a list of IDs for
                          links leaving this node.
       reverseStar ------ the same as forwardStar, but for links entering this node.
-      pathFlows -------- a dictionary whose keys are paths (described as tuples of link IDs), and whose values are
-                         lists of path flows at each time step.
-      pathTravelTimes -- a dictionary whose keys are paths (described as tuples of link IDs), and whose values are
-                         lists of path travel times for each possible departure time (one element per
-                         time step).
+      loadingPlan ------ a LoadingPlan with the link numbering, node lists and buffers used by loadNetwork.
+      pathRegistry ----- a PathRegistry giving each path (described as a tuple of link IDs) a dense integer ID,
+                         which is its row in pathFlows and pathTravelTimes.
+      pathFlows -------- a PathMatrix indexed by path, whose rows hold the path flows at each time step.
+      pathTravelTimes -- a PathMatrix indexed by path, whose rows hold the path travel times for each possible
+                         departure time (one element per time step).
+      batchCellUpdate -- if True, loadNetwork updates the cells of all CTM links together in one vectorized
+                         pass per time step instead of calling linkUpdate link by link.
+      allDepartureTimeSearch -- if True, findAllShortestPaths finds paths for every departure time with one
+                         allDepartureTDSP sweep per destination instead of one TDSP call per departure time.
+      numWorkers ------- number of processes used to compute TDSP trees for different origins in
+                         findAllShortestPaths (1 means serial).  DTA keeps one pool of these processes
+                         for the whole run (see startWorkers).
+      generatePaths ---- if True, OD path sets start with free-flow shortest paths and grow whenever
+                         findAllShortestPaths finds a new path, instead of enumerating all paths.
                   
    """
    
-   def __init__(self, networkFile):   
+   def __init__(self, networkFile, generatePaths = False):   
       """
       Set up a network by reading a network file, doing some basic validation, and initializing data structures.
+      Files ending in .npz are read as binary network files written by saveNetwork.
+      By default every path in the network is enumerated up front.  With generatePaths = True, each OD pair
+      instead starts with its free-flow shortest path, and findAllShortestPaths adds new paths as it finds them.
       """
       self.links = dict()
       self.nodes = list()
       self.ODs = list()
-      self.pathFlows = dict() # Dictionary; keys are paths, values are a list of path flows (one per departure time)
-      self.pathTravelTimes = dict() # Dictionary; keys are paths, values are a list of travel times (one per departure time)
+      self.pathRegistry = pathMatrix.PathRegistry() # Path IDs; pathFlows and pathTravelTimes are set up in finalize
+      self.batchCellUpdate = False # If True, CTM links are updated together in loadNetwork
+      self.allDepartureTimeSearch = False # If True, shortest paths come from one backward sweep per destination
+      self.numWorkers = 1 # Number of processes used to compute shortest paths from different origins
+      self.workerPool = None # Process pool for parallel shortest paths, kept between calls by startWorkers
+      self.sharedTravelTimes = None # Shared memory block passing link travel times to the worker pool
+      self.travelTimeVersion = 0 # Incremented whenever new travel times are written to sharedTravelTimes
+      self.generatePaths = generatePaths # If True, path sets grow by column generation instead of enumeration
       
-      self.readNetworkFile(networkFile) # Read the network data
+      if networkFile.endswith('.npz'):
+         self.readNetworkArchive(networkFile) # Read the network data from a binary file written by saveNetwork
+      else:
+         self.readNetworkFile(networkFile) # Read the network data
       self.validate() # Check for errors
       self.finalize() # Set up all remaining data structures
 
    
    def updatePathFlows(self, targetPathFlows, stepSize):
       """
-      Updates the self.pathFlows dictionary to try to move closer to equilibrium.  In this assignment
+      Updates the self.pathFlows matrix to try to move closer to equilibrium.  In this assignment
       you will implement the convex combinations algorithm here, where the
       given stepSize is between 0 and 1, and the targetPathFlows matrix is given.
       
       You can refer to the number of vehicles departing on a particular path at a particular time
       with self.pathFlows[path][t] (for the current H matrix) or targetPathFlows[path][t] (for H*)
+
+      targetPathFlows may be a PathMatrix sharing self.pathRegistry, in which case the whole matrix
+      is updated at once, or a dictionary of lists; paths missing from it move towards zero flow, and
+      paths in it which are not in any path set are ignored.
       """
-      
-      #  *** YOUR CODE HERE ***
-      # Replace the following statement with your code for 
-      # the convex combinations algorithm.  You should take the given
-      # path flows (self.pathFlows) and change them in place (no need to return 
-      # a value, just change the entries of self.pathFlows)
-      
-      # loop over all timesteps and paths and update the pathflows given the equation for the convex combinations algorithm
-      # the purpose of the try-catch is to bypass an error that occurs when the path flow is not in targetPathFlows      
-      for t in range(self.timeHorizon):
-          for path in self.pathFlows:
-              try:
-                  self.pathFlows[path][t] = stepSize * targetPathFlows[path][t] + (1 - stepSize) * self.pathFlows[path][t]
-              except KeyError:
-                  self.pathFlows[path][t] = (1 - stepSize) * self.pathFlows[path][t]
+      pathFlows = self.pathFlows.matrix()
+      pathFlows *= 1 - stepSize
+      if isinstance(targetPathFlows, pathMatrix.PathMatrix) and targetPathFlows.registry is self.pathRegistry:
+         pathFlows += stepSize * targetPathFlows.matrix()
+      else:
+         for path in targetPathFlows:
+            if path not in self.pathRegistry: continue
+            pathFlows[self.pathRegistry.index[path]] += stepSize * numpy.asarray(targetPathFlows[path], dtype = float)
                   
                 
-   def TDSP(self, origin, departureTime):
+   def swapPathFlows(self, swapRate):
+      """
+      Path-swapping alternative to updatePathFlows.  For each OD pair and departure time, every path
+      costlier than the cheapest path in the OD pair's path set moves a fraction of its flow to that
+      cheapest path.  The fraction is swapRate times the path's relative excess cost
+      (cost - cheapest cost) / cheapest cost, capped at 1.  Uses the current self.pathTravelTimes, so
+      flow keeps moving until all used paths have equal travel times.
+      """
+      pathFlows = self.pathFlows.matrix()
+      pathTravelTimes = self.pathTravelTimes.matrix()
+      columns = numpy.arange(self.timeHorizon)
+      for OD in self.ODs:
+         if len(OD.paths) < 2: continue
+         rows = numpy.array([self.pathRegistry.index[path] for path in OD.paths])
+         flows = pathFlows[rows]
+         costs = pathTravelTimes[rows].astype(float)
+         cheapest = costs.argmin(axis = 0)
+         minCost = costs[cheapest, columns]
+         shift = flows * numpy.minimum(1, swapRate * (costs - minCost) / numpy.maximum(minCost, 1))
+         flows -= shift
+         flows[cheapest, columns] += shift.sum(axis = 0)
+         pathFlows[rows] = flows
+
+   def TDSP(self, origin, departureTime, labels = None):
       """
       Executes a one-to-all time-dependent shortest path algorithm to find the best paths from
       a given origin and departure time to all other nodes.  This method should return a tuple
       containing the cost and backlink labels for each node.  Each of these labels is expressed
-      in a list with one element per node.
+      in a list with one element per node.  labels is an optional ShortestPathLabels object whose
+      lists are reused (see timeDependentDijkstra).
       """
-      cost = [0] * self.numNodes
-      backlink = [0] * self.numNodes
-         
-      #  *** YOUR CODE HERE ***
-      # Replace the following statement with your code for a one-to-all
-      # time-dependent shortest path algorithm.  
-      # Return the correct values of the cost and backlink labels when done.
-      # Use the INFINITY macro for undefined cost labels, and the NO_PATH macro for
-      # undefined backlink labels.
-      
-      # create an empty list for keeping track of which nodes are finalized
-      finalizedNodes = list()
-      
-      # initialize the cost and backlink labels, and fill the finalizedNodes list with zeros
-      for n in range(self.numNodes):
-          cost[n] = INFINITY
-          backlink[n] = NO_PATH
-          finalizedNodes.append(0)
-      
-      # initialize the cost of the origin
-      cost[origin] = departureTime
-      
-      # as long as there are still unfinalized nodes (given by zeros in the finalizedNodes list)
-      while 0 in finalizedNodes:
-          
-          # create two placeholder variables 
-          # minNode will keep track of the node with the minimum cost found so far
-          # currentMinCost will keep track of the minimum cost found so far
-          minNode = -1
-          currentMinCost = INFINITY
-          
-          # loop over all nodes. if the node is unfinalized and its cost is lower than the currentMinCost, update placeholder variables
-          for i in range(self.numNodes):
-              if finalizedNodes[i] == 0 and cost[i] < currentMinCost:
-                  currentMinCost = cost[i]
-                  minNode = i
-          
-          # for cases where there is no minimum node, break the loop
-          if minNode == -1:
-              break
-          
-            # otherwise, finalize the minNode
-          finalizedNodes[minNode] = 1  
-          
-          # for all the links coming from the minNode, perform the algorithm calculations
-          for i in self.forwardStar[minNode]:
-              if cost[minNode] + self.links[i].travelTime[cost[minNode]] < cost[self.links[i].head]:
-                  cost[self.links[i].head] = cost[minNode] + self.links[i].travelTime[cost[minNode]]
-                  backlink[self.links[i].head] = i
-
-      return (cost, backlink)
+      return timeDependentDijkstra(self.numNodes, self.forwardStar, self.links, origin, departureTime, labels)
    
-   def DTA(self, numIterations = 100, targetAEC = 0.1):
+   def DTA(self, numIterations = 100, targetAEC = 0.1, stepSizeRule = None, method = CONVEX_COMBINATIONS, warmStartFile = None):
       """
       Performs dynamic traffic assignment on the network, implementing the framework given
       in the textbook by iterating between network loading, time-dependent shortest path,
       and updating path flows.
+
+      With method = CONVEX_COMBINATIONS, path flows move towards the all-or-nothing assignment, and
+      stepSizeRule (a StepSizeRule object from the stepSize module) chooses the step in each iteration;
+      the default is the method of successive averages.  With method = PATH_SWAPPING, flows are instead
+      shifted from costlier to cheaper paths by swapPathFlows, with stepSizeRule giving the swap rate
+      (a constant 1 by default).
+
+      If warmStartFile is given, the initial path flows are read from a file written by savePathFlows
+      instead of coming from an all-or-nothing assignment.
       """
-      self.initializePathFlows()
-      for self.iteration in range(0, numIterations):
-         print("Starting iteration %d ..." % (self.iteration + 1), end='')
-         self.loadNetwork()
-         self.calculateTravelTimes()
-         targetPaths = self.findAllShortestPaths() # Returns h*
-         AEC = self.averageExcessCost(recomputeSPTT = False) # No need to recompute SPTT since we just found them.
-         print("average excess cost is", AEC)
-         if AEC < targetAEC: break
-         self.updatePathFlows(targetPaths, 1.0 / (self.iteration + 2))
+      if method not in (CONVEX_COMBINATIONS, PATH_SWAPPING):
+         print("Unknown DTA method %s" % method)
+         raise ValueError
+      if stepSizeRule == None:
+         stepSizeRule = stepSize.MSA() if method == CONVEX_COMBINATIONS else stepSize.ConstantStep(1.0)
+      stepSizeRule.reset()
+      self.startWorkers() # one pool of shortest path workers is used by every iteration
+      try:
+         if warmStartFile != None:
+            self.loadPathFlows(warmStartFile)
+         else:
+            self.initializePathFlows()
+         for self.iteration in range(0, numIterations):
+            print("Starting iteration %d ..." % (self.iteration + 1), end='')
+            self.loadNetwork()
+            self.calculateTravelTimes()
+            targetPaths = self.findAllShortestPaths() # Returns h*
+            AEC = self.averageExcessCost(recomputeSPTT = False) # No need to recompute SPTT since we just found them.
+            print("average excess cost is", AEC)
+            if AEC < targetAEC: break
+            if method == PATH_SWAPPING:
+               self.swapPathFlows(stepSizeRule.stepSize(self.iteration, self, AEC))
+            else:
+               self.updatePathFlows(targetPaths, stepSizeRule.stepSize(self.iteration, self, AEC))
+      finally:
+         self.stopWorkers()
 
    def initializePathFlows(self):
       """
@@ -171,41 +437,134 @@ class Network:
       To avoid duplicating code, this is implemented by calling findAllShortestPaths and updatePathFlows
       with a step size of 1.
       """
-      for OD in self.ODs:
-         for path in OD.paths:
-            self.pathFlows[path] = [0 for t in range(0,self.timeHorizon)]
+      self.pathFlows.matrix()[:] = 0
       self.updatePathFlows(self.findAllShortestPaths(), 1.0)
+
+   def savePathFlows(self, fileName):
+      """
+      Writes the path sets and current path flows to a file, so that a later DTA run can start from them
+      by passing the file name as warmStartFile.  After the time horizon, each line lists the link IDs on
+      a path followed by its flow at each departure time, as in the convex combinations test files.
+      """
+      pathFlows = self.pathFlows.matrix()
+      with open(fileName, "w") as outFile:
+         outFile.write("# Time horizon\n%d\n\n" % self.timeHorizon)
+         outFile.write("# Path flows: link IDs, then flow at each departure time\n")
+         for row, path in enumerate(self.pathRegistry.paths):
+            outFile.write(",".join(list(path) + [repr(x) for x in pathFlows[row].tolist()]) + "\n")
+
+   def loadPathFlows(self, fileName):
+      """
+      Replaces the current path flows with those in a file written by savePathFlows, reconciling them
+      with the current OD path sets.  Saved paths which are not in any path set are added to it if they
+      connect an OD pair and generatePaths is set, and are otherwise ignored.  Paths without saved flows
+      start at zero.  Saved flows are then rescaled so that each OD pair's flows at each departure time
+      match its current demand; where nothing was saved for a departure time with demand, the
+      all-or-nothing assignment at current travel times is used instead.
+      """
+      savedTimeHorizon = IS_MISSING
+      pathFlows = self.pathFlows.matrix()
+      pathFlows[:] = 0
+      try:
+         with open(fileName, "r") as flowFile:
+            for line in flowFile:
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+               if savedTimeHorizon == IS_MISSING:
+                  savedTimeHorizon = int(line)
+                  continue
+               inputs = line.strip().split(",")
+               path = tuple(ij.strip() for ij in inputs[:-savedTimeHorizon])
+               flows = [float(x) for x in inputs[-savedTimeHorizon:]][:self.timeHorizon]
+               if path not in self.pathRegistry:
+                  OD = self.pathOD(path)
+                  if OD == None or not self.generatePaths:
+                     print("Ignoring saved path %s, which is not in the current path sets" % (path,))
+                     continue
+                  self.addPath(OD, path)
+                  pathFlows = self.pathFlows.matrix()
+               pathFlows[self.pathRegistry.index[path], :len(flows)] = flows
+      except (IOError, ValueError):
+         print("\nError reading path flow file %s" % fileName)
+         traceback.print_exc(file=sys.stdout)
+         raise utils.BadFileFormatException
+
+      # The all-or-nothing assignment is found before any flows are rescaled, since it may add paths to the
+      # path sets and so reallocate the path flow matrix
+      targetPathFlows = None
+      for OD in self.ODs:
+         rows = [self.pathRegistry.index[path] for path in OD.paths]
+         if numpy.any((pathFlows[rows].sum(axis = 0) <= 0) & (OD.demandRates.dense() > 0)):
+            targetPathFlows = self.findAllShortestPaths()
+            pathFlows = self.pathFlows.matrix()
+            break
+            
+      for OD in self.ODs:
+         rows = [self.pathRegistry.index[path] for path in OD.paths]
+         flows = pathFlows[rows]
+         totals = flows.sum(axis = 0)
+         demand = OD.demandRates.dense().astype(float)
+         saved = totals > 0
+         flows[:, saved] *= demand[saved] / totals[saved]
+         if numpy.any(demand[~saved] > 0):
+            flows[:, ~saved] = targetPathFlows.matrix()[rows][:, ~saved]
+         pathFlows[rows] = flows
+
+   def pathOD(self, path):
+      """
+      Returns the OD pair connected by a path of consecutive links, or None if there is no such OD pair.
+      """
+      if len(path) == 0 or any(ij not in self.links for ij in path): return None
+      for ij, jk in zip(path[:-1], path[1:]):
+         if self.links[ij].head != self.links[jk].tail: return None
+      for OD in self.ODs:
+         if OD.origin == self.links[path[0]].tail and OD.destination == self.links[path[-1]].head:
+            return OD
+      return None
            
    def loadNetwork(self):
       """
       Implements the network loading algorithm described in Chapter 10 of the text, using calls
       to the Link and Node objects.
       """
-      # 1. Initialize; use dict's to store sending and receiving flows for each link
-      sendingFlow = dict()
-      receivingFlow = dict()
-      for ij in self.links: # Reset all counts
-         self.links[ij].upstreamPathCount = list()
-         self.links[ij].downstreamPathCount = list()
-         self.links[ij].upstreamPathCount.append(dict())
-         self.links[ij].downstreamPathCount.append(dict())
+      # 1. Initialize; the loading plan holds lists for the sending and receiving flows of each link
+      plan = self.loadingPlan
+      sendingFlow = plan.sendingFlow
+      receivingFlow = plan.receivingFlow
+      for loadLink in plan.links: # Reset all counts
+         loadLink.resetCounts(self.timeHorizon)
+      self.scheduleDepartures()
+
+      # Optionally pack all CTM links' cells together so they can be updated in one pass
+      cellBatch = None
+      individualLinks = list(range(len(plan.links)))
+      cellLinks = [loadLink for loadLink in plan.links if isinstance(loadLink, linkModel.CellTransmissionModelLink)]
+      if self.batchCellUpdate and len(cellLinks) > 0:
+         cellBatch = linkModel.CellBatch(cellLinks)
+         cellIndices = [plan.linkIndex[cellLink.ID] for cellLink in cellBatch.links]
+         individualLinks = [k for k in individualLinks if not isinstance(plan.links[k], linkModel.CellTransmissionModelLink)]
+      individualLinks = [(k, plan.links[k]) for k in individualLinks]
          
       for t in range(self.timeHorizon):
          # 2. Calculate sending and receiving flows for all links
-         for ij in self.links:
-            sendingFlow[ij], receivingFlow[ij] = self.links[ij].linkUpdate(t)
-
-         for i in range(self.numNodes):
-            # Ignore centroids for now
-            if hasattr(self.nodes[i], 'isCentroid'): continue
-
-            # 3. Calculate transition flows for all nodes         
-            self.nodes[i].proportion = self.nodes[i].calculateProportions(t)   
-            transitionFlows =  self.nodes[i].calculateTransitionFlows( { self.links[ij] : sendingFlow[ij] for ij in self.reverseStar[i] },
-                                                                       { self.links[ij] : receivingFlow[ij] for ij in self.forwardStar[i] },
-                                                                         self.nodes[i].proportion)
+         for k, loadLink in individualLinks:
+            sendingFlow[k], receivingFlow[k] = loadLink.linkUpdate(t)
+         if cellBatch != None:
+            for k, (cellLink, linkSendingFlow, linkReceivingFlow) in zip(cellIndices, cellBatch.linkUpdate(t)):
+               sendingFlow[k], receivingFlow[k] = linkSendingFlow, linkReceivingFlow
+
+         # Centroids are handled by loadTrips and terminateTrips
+         for junction, inLinks, outLinks, inIndices, outIndices, nodeSendingFlow, nodeReceivingFlow in plan.junctions:
+            for inLink, k in zip(inLinks, inIndices):
+               nodeSendingFlow[inLink] = sendingFlow[k]
+            for outLink, k in zip(outLinks, outIndices):
+               nodeReceivingFlow[outLink] = receivingFlow[k]
+
+            # 3. Calculate transition flows for all nodes, reusing the sending flows found by linkUpdate
+            junction.proportion = junction.calculateProportions(t, nodeSendingFlow)   
+            transitionFlows = junction.calculateTransitionFlows(nodeSendingFlow, nodeReceivingFlow, junction.proportion)
             # 4. Move flow
-            self.nodes[i].moveFlow(transitionFlows, t)
+            junction.moveFlow(transitionFlows, t)
             
          # 5. Load trips at origins
          self.loadTrips(t)
@@ -219,28 +578,37 @@ class Network:
       vehicles before adding... origin centroid connectors should have infinite density so this will not
       be a problem as long as your centroid connectors are coded correctly.
       """
-      inFlows = dict() # a two-key dictionary; first key is starting link, second key is path
-      for ij in self.links:
-         inFlows[ij] = dict()
-         
-      for OD in self.ODs:
-         for path in OD.paths:
-            if self.pathFlows[path][t] > 0:
-               inFlows[path[0]][path] = self.pathFlows[path][t]
+      inFlows = dict() # a two-key dictionary; first key is starting link, second key is path ID
+      start, end = self.departureOffsets[t], self.departureOffsets[t + 1]
+      for row, flow in zip(self.departureRows[start:end].tolist(), self.departureFlows[start:end].tolist()):
+         inFlows.setdefault(self.pathRegistry.paths[row][0], dict())[row] = flow
                
-      for ij in self.links:
-         if hasattr(self.nodes[self.links[ij].tail], 'isCentroid'):
-            self.links[ij].flowIn(inFlows[ij])
+      for ij, connector in self.loadingPlan.originConnectors:
+         connector.flowIn(inFlows.get(ij, dict()))
+   
+   def scheduleDepartures(self):
+      """
+      Indexes the current path flows by departure time for loadTrips, so the path flow matrix is scanned
+      once per loading rather than once per time step.  departureRows holds the IDs of paths with positive
+      flow, sorted by departure time, and departureFlows their flows; the entries for time t run from
+      departureOffsets[t] up to departureOffsets[t + 1].  Called by loadNetwork before loading starts.
+      """
+      pathFlows = self.pathFlows.matrix()
+      times, self.departureRows = numpy.nonzero(pathFlows.T > 0) # ordered by departure time
+      self.departureFlows = pathFlows[self.departureRows, times]
+      self.departureOffsets = numpy.searchsorted(times, numpy.arange(self.timeHorizon + 1)).tolist()
    
    def terminateTrips(self, t):
       """
       Removes flow from the network at the destination end of paths.
       """
-      for i in range(self.numNodes):
-         if hasattr(self.nodes[i], 'isDestination'):
-            self.nodes[i].calculateDisaggregateSendingFlows(t)
-            for ij in self.reverseStar[i]:
-               self.links[ij].flowOut(self.nodes[i].disaggregateSendingFlow[self.links[ij]])
+      sendingFlow = self.loadingPlan.sendingFlow
+      for destination, inLinks, inIndices, nodeSendingFlow in self.loadingPlan.destinations:
+         for inLink, k in zip(inLinks, inIndices):
+            nodeSendingFlow[inLink] = sendingFlow[k]
+         destination.calculateDisaggregateSendingFlows(t, nodeSendingFlow)
+         for inLink in inLinks:
+            inLink.flowOut(destination.disaggregateSendingFlow[inLink])
    
    def calculateTravelTimes(self):
       """
@@ -253,72 +621,345 @@ class Network:
       """
       Updates travel times for all links in the network, based on matching
       upstream/downstream counts.  tolerance argument is used to control numerical errors.
+
+      Downstream counts never decrease, so the exit time for every entry time is found at once
+      by binary search (numpy.searchsorted), never earlier than the free-flow exit time and never
+      later than the end of the time horizon.
       """
+      entryTime = numpy.arange(self.timeHorizon)
       for ij in self.links:
-         for entryTime in range(self.timeHorizon):
-            n = self.links[ij].upstreamCount(entryTime)
-            exitTime = entryTime + self.links[ij].freeFlowTime
-            while exitTime < self.timeHorizon:
-               if self.links[ij].downstreamCount(exitTime) >= n - tolerance: break
-               exitTime += 1
-            self.links[ij].travelTime[entryTime] = exitTime - entryTime          
+         currentLink = self.links[ij]
+         upstreamCount = currentLink.upstreamPathCount.totals[:self.timeHorizon]
+         downstreamCount = currentLink.downstreamPathCount.totals[:self.timeHorizon]
+         # first time when the downstream count catches up with the upstream count at each entry time...
+         exitTime = numpy.searchsorted(downstreamCount, upstreamCount - tolerance, side = 'left')
+         # ...but no earlier than the free-flow exit time
+         freeFlowExitTime = entryTime + currentLink.freeFlowTime
+         exitTime = numpy.where(freeFlowExitTime < self.timeHorizon, numpy.maximum(exitTime, freeFlowExitTime), freeFlowExitTime)
+         currentLink.travelTime[:] = (exitTime - entryTime).tolist()
       
    def calculatePathTravelTimes(self):
       """
       Updates travel times for all paths in the network, by chaining together the
       time-dependent travel times of their constituent links.
+
+      Paths are arranged in a prefix tree of link IDs, so the arrival times for a prefix shared
+      by several paths (such as a common origin connector) are only calculated once.
       """
+      linkTravelTimes = {ij : numpy.array(self.links[ij].travelTime, dtype = int) for ij in self.links}
+      
+      # Each tree node is a dictionary whose keys are the IDs of the next links; the key None marks
+      # the end of a path and stores the path itself
+      prefixTree = dict()
       for OD in self.ODs:
          for path in OD.paths:
-            self.pathTravelTimes[path] = [0 for t in range(self.timeHorizon)] 
-            pathArrivalTime = [t for t in range(self.timeHorizon)]
+            treeNode = prefixTree
             for ij in path:
-               for t in range(self.timeHorizon):
-                  self.pathTravelTimes[path][t] += self.links[ij].travelTime[pathArrivalTime[t]]
-                  pathArrivalTime[t] += self.links[ij].travelTime[pathArrivalTime[t]]
-                  pathArrivalTime[t] = min(pathArrivalTime[t], self.timeHorizon - 1)
+               treeNode = treeNode.setdefault(ij, dict())
+            treeNode[None] = path
+            
+      # Depth-first search, carrying the travel times and arrival times at the end of each prefix
+      stack = [(prefixTree, numpy.zeros(self.timeHorizon, dtype = int), numpy.arange(self.timeHorizon))]
+      while len(stack) > 0:
+         treeNode, pathTravelTime, pathArrivalTime = stack.pop()
+         for ij in treeNode:
+            if ij == None:
+               self.pathTravelTimes[treeNode[ij]] = pathTravelTime
+               continue
+            linkTravelTime = linkTravelTimes[ij][pathArrivalTime]
+            stack.append((treeNode[ij], pathTravelTime + linkTravelTime, numpy.minimum(pathArrivalTime + linkTravelTime, self.timeHorizon - 1)))
+
+   def calculatePathTravelTime(self, path, linkTravelTimes = None):
+      """
+      Updates the travel times of a single path for every departure time.  Arrival times at the
+      end of each link are propagated for all departure times at once, using linkTravelTimes (a
+      dictionary of integer NumPy arrays with link IDs as keys) if given.
+      """
+      if linkTravelTimes == None:
+         linkTravelTimes = {ij : numpy.array(self.links[ij].travelTime, dtype = int) for ij in path}
+      pathTravelTime = numpy.zeros(self.timeHorizon, dtype = int)
+      pathArrivalTime = numpy.arange(self.timeHorizon)
+      for ij in path:
+         linkTravelTime = linkTravelTimes[ij][pathArrivalTime]
+         pathTravelTime += linkTravelTime
+         pathArrivalTime = numpy.minimum(pathArrivalTime + linkTravelTime, self.timeHorizon - 1)
+      self.pathTravelTimes[path] = pathTravelTime
+
+   def addPath(self, OD, path):
+      """
+      Adds a newly generated path to an OD pair's path set.  Its flows start at zero and its travel
+      times are calculated from the current link travel times.
+      """
+      OD.paths.append(path)
+      self.pathFlows[path] = 0
+      self.pathClassShares[self.pathRegistry.index[path]] = OD.classShares
+      self.calculatePathTravelTime(path)
    
    def findAllShortestPaths(self):
       """
       Finds shortest paths for all OD pairs in the network, using repeated calls to
       the TDSP method, and identify an all-or-nothing assignment which places all demand
-      on these paths just found.  This method returns the targetPathFlows dictionary which
-      contains this all-or-nothing assignment.
+      on these paths just found.  This method returns the targetPathFlows matrix (a PathMatrix
+      sharing self.pathRegistry) which contains this all-or-nothing assignment.
+
+      If allDepartureTimeSearch is set, paths are found with one allDepartureTDSP sweep per
+      destination instead of one TDSP call per origin and departure time.
       """
       self.SPTT = 0
-      targetPathFlows = dict()
+      targetPathFlows = pathMatrix.PathMatrix(self.pathRegistry, self.timeHorizon)
+      if self.allDepartureTimeSearch:
+         shortestPaths = self.shortestPathsByDestination()
+      else:
+         shortestPaths = self.shortestPathsByOrigin()
+      
+      for OD, t, path, pathTravelTime in shortestPaths:
+         if self.generatePaths and path not in self.pathFlows:
+            self.addPath(OD, path)
+         # Add the relevant entry in the all-or-nothing assignment
+         targetPathFlows[path][t] = OD.demandRates[t]
+         self.SPTT += OD.demandRates[t] * pathTravelTime
+            
+      return targetPathFlows   
+
+   def shortestPathsByOrigin(self):
+      """
+      Generates a tuple (OD, departure time, path, travel time) with the shortest path for every OD pair
+      and departure time with positive demand.  OD pairs are grouped by origin, so each one-to-all TDSP
+      tree is computed once per origin and departure time and shared by every destination with demand
+      at that time.  If numWorkers is more than 1, the trees are computed in parallel by
+      parallelShortestPaths; the results are generated in the same order either way.
+      """
+      originODs = dict() # keys are origins, values are lists of OD pairs starting there
       for OD in self.ODs:
-         for t in range(self.timeHorizon):
-            if OD.demandRates[t] > 0:
-               # Find shortest path...
-               cost, backlink = self.TDSP(OD.origin, t)
-               if backlink[OD.destination] == None:
+         originODs.setdefault(OD.origin, list()).append(OD)
+         
+      if self.numWorkers > 1:
+         parallelPaths = self.parallelShortestPaths(originODs)
+      else:
+         labels = ShortestPathLabels(self.numNodes) # reused by every TDSP call below
+         
+      for origin in originODs:
+         for t, departingODs in self.departingODs(originODs[origin]):
+            # Find shortest paths to all destinations...
+            if self.numWorkers > 1:
+               paths = parallelPaths[(origin, t)]
+            else:
+               paths = destinationPaths(self.links, origin, t, [OD.destination for OD in departingODs], self.TDSP(origin, t, labels))
+            for OD in departingODs:
+               path, pathTravelTime = paths[OD.destination]
+               if path == None:
                   print("Unable to find a path from %d to %d within the time horizon, when departing at time %d." % (OD.origin, OD.destination, t))
                   sys.exit(EXIT_FAILURE)
-               # ...now reconstruct it from the labels...
-               curNode = OD.destination
-               tempPath = list()
-               while curNode != OD.origin:
-                  tempPath.insert(0, backlink[curNode])
-                  curNode = self.links[backlink[curNode]].tail
-               path = tuple(tempPath)
-               # ...and add the relevant entry in the all-or-nothing assignment
-               if path not in targetPathFlows:
-                  targetPathFlows[path] = [0] * self.timeHorizon
-               targetPathFlows[path][t] = OD.demandRates[t]
-               self.SPTT += OD.demandRates[t] * (cost[OD.destination] - t)
+               yield (OD, t, path, pathTravelTime)
+
+   def departingODs(self, ODs):
+      """
+      Returns a list of (departure time, OD pairs) tuples, in increasing order of departure time, giving
+      the OD pairs from the list ODs with positive demand at each time.
+      """
+      departures = dict() # keys are departure times, values are lists of OD pairs
+      for OD in ODs:
+         for t in OD.demandRates.departureTimes():
+            departures.setdefault(t, list()).append(OD)
+      return sorted(departures.items(), key = lambda departure: departure[0])
+
+   def parallelShortestPaths(self, originODs):
+      """
+      Computes TDSP trees for every origin and departure time with demand using a pool of numWorkers
+      processes.  Link travel times are copied once into a shared memory block, and each worker handles a
+      shard of the origins.  Returns a dictionary whose keys are (origin, departure time) and whose values
+      are the dictionaries returned by destinationPaths.
+
+      The pool and the shared block started by startWorkers are reused if they are running; otherwise a
+      pool is started for this call only.
+      """
+      linkIDs = list(self.links)
+      travelTime = numpy.array([self.links[ij].travelTime for ij in linkIDs], dtype = numpy.int64).reshape(len(linkIDs), -1)
+      if self.sharedTravelTimes != None and self.sharedTravelTimes.size < travelTime.nbytes:
+         self.freeSharedTravelTimes()
+      if self.sharedTravelTimes == None:
+         self.sharedTravelTimes = shared_memory.SharedMemory(create = True, size = max(travelTime.nbytes, 1))
+      numpy.ndarray(travelTime.shape, dtype = numpy.int64, buffer = self.sharedTravelTimes.buf)[:] = travelTime
+      self.travelTimeVersion += 1
+      tails = [self.links[ij].tail for ij in linkIDs]
+      heads = [self.links[ij].head for ij in linkIDs]
+      
+      # Split origins into several shards per worker to balance the load
+      tasks = list()
+      for origin in originODs:
+         for t, departingODs in self.departingODs(originODs[origin]):
+            tasks.append((origin, t, [OD.destination for OD in departingODs]))
+      origins = list(originODs)
+      numShards = min(len(origins), 4 * self.numWorkers)
+      shardOrigins = [set(origins[k::numShards]) for k in range(numShards)]
+      shards = [[task for task in tasks if task[0] in shard] for shard in shardOrigins]
+      
+      paths = dict()
+      temporaryPool = self.workerPool == None
+      try:
+         self.startWorkers()
+         futures = [self.workerPool.submit(originShortestPaths, self.sharedTravelTimes.name, self.travelTimeVersion, travelTime.shape,
+                                           self.numNodes, self.forwardStar, linkIDs, tails, heads, shard) for shard in shards]
+         for future in futures:
+            paths.update(future.result())
+      finally:
+         if temporaryPool: self.stopWorkers()
+      return paths
+
+   def startWorkers(self):
+      """
+      Starts the pool of numWorkers processes used by parallelShortestPaths, so that the same processes
+      (and shared travel time block) serve every findAllShortestPaths call until stopWorkers is called.
+      Does nothing if numWorkers is 1 or the pool is already running.
+      """
+      if self.numWorkers > 1 and self.workerPool == None:
+         self.workerPool = concurrent.futures.ProcessPoolExecutor(self.numWorkers)
+
+   def stopWorkers(self):
+      """
+      Shuts down the pool started by startWorkers and frees the shared travel time block.
+      """
+      if self.workerPool != None:
+         self.workerPool.shutdown()
+         self.workerPool = None
+      self.freeSharedTravelTimes()
+
+   def freeSharedTravelTimes(self):
+      """
+      Releases the shared memory block holding link travel times for the worker pool, if there is one.
+      """
+      if self.sharedTravelTimes != None:
+         self.sharedTravelTimes.close()
+         self.sharedTravelTimes.unlink()
+         self.sharedTravelTimes = None
+
+   def shortestPathsByDestination(self):
+      """
+      Generates the same tuples as shortestPathsByOrigin, but using one allDepartureTDSP sweep per
+      destination.  When several paths are equally short, ties may be broken differently than TDSP.
+      """
+      destinationODs = dict() # keys are destinations, values are lists of OD pairs ending there
+      for OD in self.ODs:
+         destinationODs.setdefault(OD.destination, list()).append(OD)
+         
+      linkArrays = self.linkArrays() # shared by the sweeps for every destination
+      linkIDs = linkArrays[0]
+      for destination in destinationODs:
+         arrival, nextLink = self.allDepartureTDSP(destination, linkArrays)
+         for OD in destinationODs[destination]:
+            for t in OD.demandRates.departureTimes():
+               if arrival[OD.origin][t] >= INFINITY:
+                  print("Unable to find a path from %d to %d within the time horizon, when departing at time %d." % (OD.origin, OD.destination, t))
+                  sys.exit(EXIT_FAILURE)
+               yield (OD, t, self.followNextLinks(OD.origin, t, destination, nextLink, linkIDs), int(arrival[OD.origin][t]) - t)
+
+   def linkArrays(self):
+      """
+      Returns a tuple (linkIDs, linkIndex, tails, heads, travelTime) describing every link for allDepartureTDSP:
+      the list of link IDs, a dictionary giving the position of each ID in that list, NumPy arrays with the tail
+      and head of each link, and an array with one row per link holding its travel times over the time horizon.
+      """
+      T = self.timeHorizon
+      linkIDs = list(self.links)
+      linkIndex = {ij : k for k, ij in enumerate(linkIDs)}
+      tails = numpy.array([self.links[ij].tail for ij in linkIDs], dtype = int)
+      heads = numpy.array([self.links[ij].head for ij in linkIDs], dtype = int)
+      travelTime = numpy.array([self.links[ij].travelTime[:T] for ij in linkIDs], dtype = int).reshape(len(linkIDs), T)
+      return (linkIDs, linkIndex, tails, heads, travelTime)
+
+   def allDepartureTDSP(self, destination, linkArrays = None):
+      """
+      Executes an all-to-one time-dependent shortest path algorithm for every departure time at once,
+      scanning departure times in decreasing order so that each label only depends on labels which are
+      already final (links with zero travel time are handled by repeating a time step until its labels
+      stop changing).  Travel times after the end of the time horizon are assumed to stay at their values
+      in the last time step.
+
+      Returns a tuple (arrival, nextLink) of NumPy arrays with one row per node.  arrival[i][t] is the
+      earliest arrival time at the destination when leaving node i at time t (INFINITY if it cannot be
+      reached).  nextLink[i][t] is the position in self.links of the first link on that path (-1 if there
+      is none); its extra last column gives the first link for departures after the time horizon.
+
+      linkArrays is the tuple returned by linkArrays; pass it in when sweeping for several destinations
+      with the same travel times, so the arrays are only built once.
+      """
+      T = self.timeHorizon
+      if linkArrays == None: linkArrays = self.linkArrays()
+      linkIDs, linkIndex, tails, heads, travelTime = linkArrays
+      
+      arrival = numpy.full((self.numNodes, T), INFINITY, dtype = int)
+      nextLink = numpy.full((self.numNodes, T + 1), -1, dtype = int)
+      
+      # After the time horizon travel times are static; label these with a backward Dijkstra search
+      staticCost = [INFINITY] * self.numNodes
+      staticCost[destination] = 0
+      heap = [(0, destination)]
+      while len(heap) > 0:
+         minCost, j = heapq.heappop(heap)
+         if minCost > staticCost[j]: continue
+         for ij in self.reverseStar[j]:
+            k = linkIndex[ij]
+            newCost = minCost + travelTime[k][T - 1]
+            if newCost < staticCost[tails[k]]:
+               staticCost[tails[k]] = newCost
+               nextLink[tails[k]][T] = k
+               heapq.heappush(heap, (newCost, tails[k]))
+      staticCost = numpy.array(staticCost, dtype = int)
+      
+      for t in reversed(range(T)):
+         exitTime = t + travelTime[:, t]
+         inHorizon = exitTime < T
+         arrival[destination][t] = t
+         while True:
+            # Arrival time at the destination when using each link, then the best arrival out of each node
+            linkArrival = numpy.where(inHorizon, arrival[heads, numpy.minimum(exitTime, T - 1)], exitTime + staticCost[heads])
+            linkArrival = numpy.minimum(linkArrival, INFINITY)
+            bestArrival = numpy.full(self.numNodes, INFINITY, dtype = int)
+            numpy.minimum.at(bestArrival, tails, linkArrival)
+            bestArrival[destination] = t
+            improved = bestArrival < arrival[:, t]
+            if not improved.any(): break
             
-      return targetPathFlows   
+            # For nodes whose labels improved, record the lowest-numbered link achieving the new label
+            bestLinks = numpy.flatnonzero((linkArrival == bestArrival[tails]) & improved[tails])
+            nodes, first = numpy.unique(tails[bestLinks], return_index = True)
+            nextLink[nodes, t] = bestLinks[first]
+            arrival[improved, t] = bestArrival[improved]
+            
+            # Labels can only change again within this time step if some link has zero travel time
+            if travelTime[:, t].min() > 0: break
+      
+      return (arrival, nextLink)
+
+   def followNextLinks(self, origin, departureTime, destination, nextLink, linkIDs = None):
+      """
+      Reconstructs the path from origin to destination (departing at departureTime) given by the nextLink
+      labels from allDepartureTDSP, returning it as a tuple of link IDs.  linkIDs is the list of link IDs
+      the labels refer to (the first element of linkArrays); it is rebuilt if not given.
+      """
+      if linkIDs == None: linkIDs = list(self.links)
+      curNode = origin
+      curTime = departureTime
+      tempPath = list()
+      while curNode != destination:
+         ij = linkIDs[nextLink[curNode][min(curTime, self.timeHorizon)]]
+         tempPath.append(ij)
+         curTime += self.links[ij].travelTime[min(curTime, self.timeHorizon - 1)]
+         curNode = self.links[ij].head
+      return tuple(tempPath)
+
+   def tracePath(self, origin, destination, backlink):
+      """
+      Reconstructs the path from origin to destination given by a list of backlink labels,
+      returning it as a tuple of link IDs.
+      """
+      return tracePath(self.links, origin, destination, backlink)
 
    def calculateTSTT(self):
       """
       Calculate total system travel time in the Network using the current path flows and travel times.
       """
-      TSTT = 0.0
-      for path in self.pathFlows:
-         for t in range(self.timeHorizon):
-            TSTT += self.pathFlows[path][t] * self.pathTravelTimes[path][t]
-      return TSTT
+      return float((self.pathFlows.matrix() * self.pathTravelTimes.matrix()).sum())
          
    def averageExcessCost(self, recomputeSPTT = True):
       """
@@ -359,21 +1000,30 @@ class Network:
          
    def readNetworkFile(self, networkFile):
       """
-      Read a given network file and set up Link and OD objects.
+      Read a given network file and set up Link and OD objects.  The file is read one line at a time, and
+      each OD pair's demand is stored compactly as soon as its line is parsed, so large demand tables never
+      have to be held in memory as text or as lists.  Progress is reported every PROGRESS_INTERVAL OD pairs.
+
+      Vehicle classes for multi-class CTM links can optionally be given before the link data, with one
+      line per class of the form CLASS,name,length (ft),share.  When classes are given, each OD line may
+      end with one extra value per class giving the class shares for that OD pair; otherwise the default
+      shares from the CLASS lines are used.
       """
       linksRead = 0  
+      self.vehicleClasses = list()
       self.timestep = IS_MISSING
       self.timeHorizon = IS_MISSING
       self.numLinks = IS_MISSING
       self.numNodes = IS_MISSING
       self.linkPriorities = dict()
+      self.linkParameters = dict()
       self.totalDemand = 0.0
             
       try:
          with open(networkFile, "r") as testFile:
             # Read test information
-            fileLines = testFile.read().splitlines()
-            for line in fileLines:
+            for line in testFile:
+               line = line.rstrip('\r\n')
                # Ignore comments and blank lines
                if len(line.strip()) == 0 or line[0] == '#':
                   continue
@@ -388,44 +1038,159 @@ class Network:
                   self.timeHorizon = int(inputs[3])
                   continue
                   
+               # Read vehicle class data
+               inputs = line.split(",")
+               if inputs[0].strip() == 'CLASS':
+                  if len(inputs) != 4 or linksRead > 0:
+                     print("Error reading vehicle class line %s (classes must come before link data)" % inputs)
+                     raise utils.BadFileFormatException
+                  self.vehicleClasses.append(linkModel.VehicleClass(inputs[1].strip(), float(inputs[2]), float(inputs[3])))
+                  continue
+
+               if len(self.vehicleClasses) == 0:
+                  self.vehicleClasses = list(linkModel.DEFAULT_VEHICLE_CLASSES)
+
                # Read link data
                if (linksRead < self.numLinks):
-                  inputs = line.split(",")
                   if len(inputs) != 10: 
                      print("Error reading link data line %s" % inputs)
                      raise utils.BadFileFormatException
-                  uf = float(inputs[3])
-                  w = float(inputs[4])
-                  kj = float(inputs[5])
-                  L = float(inputs[6])
-                  qmax = float(inputs[7])
-                  if   inputs[9] == 'PQ':  newLink = linkModel.PointQueueLink(self.timestep, uf, w, kj, L, qmax, qmax, inputs[0])
-                  elif inputs[9] == 'SQ':  newLink = linkModel.SpatialQueueLink(self.timestep, uf, w, kj, L, qmax, qmax, inputs[0])
-                  elif inputs[9] == 'CTM': newLink = linkModel.CellTransmissionModelLink(self.timestep, uf, w, kj, L, qmax, inputs[0])
-                  elif inputs[9] == 'LTM': newLink = linkModel.LinkTransmissionModelLink(self.timestep, uf, w, kj, L, qmax, inputs[0])
-                  else: 
-                     print("Link model %s is not implemented." % inputs[9])
-                     raise utils.BadFileFormatException
-                  newLink.tail = int(inputs[1]) - 1  # Convert from 1-based (input file) to 0-based (internal)
-                  newLink.head = int(inputs[2]) - 1  # Convert from 1-based (input file) to 0-based (internal)
-                  self.links[inputs[0]] = newLink
-                  self.linkPriorities[inputs[0]] = float(inputs[8])
+                  # Convert nodes from 1-based (input file) to 0-based (internal)
+                  self.addLink(inputs[0], int(inputs[1]) - 1, int(inputs[2]) - 1, [float(x) for x in inputs[3:9]], inputs[9])
                   linksRead += 1
                   continue
                   
                # Read OD data
-               inputs = line.split(",")
-               if len(inputs) != 2 + self.timeHorizon:
+               if len(inputs) == 2 + self.timeHorizon:
+                  shares = linkModel.classShares(self.vehicleClasses)
+               elif len(inputs) == 2 + self.timeHorizon + len(self.vehicleClasses):
+                  shares = numpy.array([float(x) for x in inputs[2 + self.timeHorizon:]])
+                  inputs = inputs[:2 + self.timeHorizon]
+               else:
                   print("Wrong number of demand values for OD pair")
                   raise utils.BadFileFormatException
-               newOD = OD(int(inputs[0]) - 1, int(inputs[1]) - 1, [int(d) for d in inputs[2:]]) # Convert from 1-based (input file) to 0-based (internal)
-               self.ODs.append(newOD)
-               self.totalDemand += sum(newOD.demandRates)
+               self.addOD(int(inputs[0]) - 1, int(inputs[1]) - 1, [int(d) for d in inputs[2:]], shares) # Convert from 1-based (input file) to 0-based (internal)
+               if len(self.ODs) % PROGRESS_INTERVAL == 0:
+                  print("Read %d OD pairs..." % len(self.ODs))
                
       except IOError:
          print("\nError reading network file %s" % networkFile)
          traceback.print_exc(file=sys.stdout) 
 
+   def addLink(self, ID, tail, head, parameters, linkType):
+      """
+      Creates a link from the values on a link data line.  tail and head are 0-based node numbers, and
+      parameters lists the free-flow speed, backward wave speed, jam density, length, capacity and priority
+      in the units of the network file.
+      """
+      uf, w, kj, L, qmax, priority = parameters
+      if   linkType == 'PQ':  newLink = linkModel.PointQueueLink(self.timestep, uf, w, kj, L, qmax, qmax, ID)
+      elif linkType == 'SQ':  newLink = linkModel.SpatialQueueLink(self.timestep, uf, w, kj, L, qmax, qmax, ID)
+      elif linkType == 'CTM': newLink = linkModel.CellTransmissionModelLink(self.timestep, uf, w, kj, L, qmax, ID, self.vehicleClasses)
+      elif linkType == 'LTM': newLink = linkModel.LinkTransmissionModelLink(self.timestep, uf, w, kj, L, qmax, ID)
+      else: 
+         print("Link model %s is not implemented." % linkType)
+         raise utils.BadFileFormatException
+      newLink.tail = tail
+      newLink.head = head
+      self.links[ID] = newLink
+      self.linkPriorities[ID] = priority
+      self.linkParameters[ID] = (list(parameters), linkType) # kept so the network can be saved again
+
+   def addOD(self, origin, destination, demandRates, shares):
+      """
+      Creates an OD pair between 0-based origin and destination nodes.  shares gives the proportion of
+      its demand in each vehicle class, and is normalized here to sum to one; shares which cannot be
+      normalized are left as they are for validate to reject.
+      """
+      shares = numpy.array(shares, dtype = float)
+      if shares.min() >= 0 and shares.sum() > 0:
+         shares = shares / shares.sum()
+      newOD = OD(origin, destination, demandRates, shares)
+      self.ODs.append(newOD)
+      self.totalDemand += newOD.demandRates.total()
+
+   def saveNetwork(self, fileName):
+      """
+      Writes the network data (vehicle classes, links, and OD pairs with their demand) to an uncompressed
+      NumPy .npz file, which can be passed to the Network constructor in place of a text network file and
+      loads without parsing any text.
+
+      Demand is stored sparsely: demandTimes and demandValues list the time steps with demand and the
+      demand at those times for every OD pair in turn, and OD pair k's entries run from demandOffsets[k]
+      up to demandOffsets[k + 1].
+      """
+      linkIDs = list(self.links)
+      demandOffsets = numpy.cumsum([0] + [len(OD.demandRates.times) for OD in self.ODs])
+      numpy.savez(fileName,
+         header = numpy.array([self.numLinks, self.numNodes, self.timestep, self.timeHorizon], dtype = float),
+         classNames = numpy.array([vehicleClass.name for vehicleClass in self.vehicleClasses]),
+         classLengths = numpy.array([vehicleClass.length for vehicleClass in self.vehicleClasses], dtype = float),
+         classShares = numpy.array([vehicleClass.share for vehicleClass in self.vehicleClasses], dtype = float),
+         linkIDs = numpy.array(linkIDs),
+         linkTypes = numpy.array([self.linkParameters[ij][1] for ij in linkIDs]),
+         linkEnds = numpy.array([(self.links[ij].tail, self.links[ij].head) for ij in linkIDs], dtype = int).reshape(-1, 2),
+         linkParameters = numpy.array([self.linkParameters[ij][0] for ij in linkIDs], dtype = float).reshape(-1, 6),
+         ODEnds = numpy.array([(OD.origin, OD.destination) for OD in self.ODs], dtype = int).reshape(-1, 2),
+         demandOffsets = demandOffsets.astype(numpy.int64),
+         demandTimes = numpy.concatenate([numpy.zeros(0, dtype = numpy.int32)] + [OD.demandRates.times for OD in self.ODs]),
+         demandValues = numpy.concatenate([numpy.zeros(0)] + [OD.demandRates.values for OD in self.ODs]),
+         ODClassShares = numpy.array([OD.classShares for OD in self.ODs], dtype = float).reshape(len(self.ODs), -1))
+
+   def readNetworkArchive(self, fileName):
+      """
+      Reads a binary network file written by saveNetwork and sets up Link and OD objects, as
+      readNetworkFile does for text network files.
+      """
+      self.linkPriorities = dict()
+      self.linkParameters = dict()
+      self.totalDemand = 0.0
+      try:
+         with numpy.load(fileName, allow_pickle = False) as archive:
+            header = archive['header']
+            self.numLinks = int(header[0])
+            self.numNodes = int(header[1])
+            self.timestep = float(header[2])
+            self.timeHorizon = int(header[3])
+            self.vehicleClasses = [linkModel.VehicleClass(str(name), float(length), float(share)) for name, length, share
+                                   in zip(archive['classNames'], archive['classLengths'], archive['classShares'])]
+            for ij, linkType, ends, parameters in zip(archive['linkIDs'], archive['linkTypes'], archive['linkEnds'], archive['linkParameters']):
+               self.addLink(str(ij), int(ends[0]), int(ends[1]), parameters.tolist(), str(linkType))
+            demandOffsets = archive['demandOffsets'].tolist()
+            demandTimes = archive['demandTimes']
+            demandValues = archive['demandValues']
+            for k, (ends, shares) in enumerate(zip(archive['ODEnds'], archive['ODClassShares'])):
+               start, end = demandOffsets[k], demandOffsets[k + 1]
+               demandRates = DemandRates(demandValues[start:end], demandTimes[start:end], self.timeHorizon)
+               self.addOD(int(ends[0]), int(ends[1]), demandRates, shares.copy())
+      except (IOError, KeyError):
+         print("\nError reading network file %s" % fileName)
+         traceback.print_exc(file=sys.stdout)
+         raise utils.BadFileFormatException
+
+   def saveResults(self, fileName):
+      """
+      Writes the results of the last network loading to an uncompressed NumPy .npz file: cumulative upstream
+      and downstream counts (one row per link, one column per time from 0 to the time horizon), link travel
+      times, and path flows and travel times.  Use loadResults to read them back without a Network.
+      """
+      linkIDs = list(self.links)
+      upstreamCounts = numpy.zeros((len(linkIDs), self.timeHorizon + 1))
+      downstreamCounts = numpy.zeros((len(linkIDs), self.timeHorizon + 1))
+      for row, ij in enumerate(linkIDs):
+         for counts, pathCount in ((upstreamCounts, self.links[ij].upstreamPathCount), (downstreamCounts, self.links[ij].downstreamPathCount)):
+            length = min(len(pathCount), self.timeHorizon + 1)
+            counts[row, :length] = pathCount.totals[:length]
+      numpy.savez(fileName,
+         timestep = numpy.array(self.timestep),
+         linkIDs = numpy.array(linkIDs),
+         upstreamCounts = upstreamCounts,
+         downstreamCounts = downstreamCounts,
+         travelTimes = numpy.array([self.links[ij].travelTime for ij in linkIDs], dtype = int).reshape(len(linkIDs), -1),
+         paths = numpy.array([",".join(path) for path in self.pathRegistry.paths]),
+         pathFlows = self.pathFlows.matrix(),
+         pathTravelTimes = self.pathTravelTimes.matrix())
+
    def validate(self):
       """
       Perform basic input validation for the network.
@@ -455,11 +1220,21 @@ class Network:
       for OD in self.ODs:
          originInRange = OD.origin >= 0 and OD.origin < self.numNodes
          destinationInRange = OD.destination >= 0 and OD.destination < self.numNodes
-         nonnegativeDemand = min(OD.demandRates) >= 0
+         nonnegativeDemand = bool((OD.demandRates.values >= 0).all())
+         validShares = min(OD.classShares) >= 0 and sum(OD.classShares) > 0
          if not originInRange: print("Network validation failed: origin %d out of range" % (OD.origin + 1))
          if not destinationInRange: print("Network validation failed: destination %d out of range" % (OD.destination + 1))
          if not nonnegativeDemand: print("Network validation failed: negative demand value for OD pair %d -> %d" % (OD.origin + 1, OD.destination + 1))
-         valid = valid and originInRange and destinationInRange and nonnegativeDemand
+         if not validShares: print("Network validation failed: invalid vehicle class shares for OD pair %d -> %d" % (OD.origin + 1, OD.destination + 1))
+         valid = valid and originInRange and destinationInRange and nonnegativeDemand and validShares
+
+      for vehicleClass in self.vehicleClasses:
+         validClass = vehicleClass.length > 0 and vehicleClass.share >= 0
+         if not validClass: print("Network validation failed: vehicle class %s has negative or zero parameters" % vehicleClass.name)
+         valid = valid and validClass
+      if sum(vehicleClass.share for vehicleClass in self.vehicleClasses) <= 0:
+         print("Network validation failed: default vehicle class shares must have a positive sum")
+         valid = False
          
       if valid == False: raise utils.BadFileFormatException
          
@@ -490,17 +1265,15 @@ class Network:
          elif len(inLinks) == 1:                        self.nodes.append(nodeModel.DivergeNode(inLinks, outLinks))
          elif len(outLinks) == 1:                       self.nodes.append(nodeModel.MergeNode(inLinks, outLinks,
                                                             {self.links[ij] : self.linkPriorities[ij] for ij in self.reverseStar[i]}))
-         else:
-            print("General intersections not yet implemented")
-            raise utils.BadFileFormatException
+         else:                                          self.nodes.append(nodeModel.GeneralNode(inLinks, outLinks,
+                                                            {self.links[ij] : self.linkPriorities[ij] for ij in self.reverseStar[i]}))
+      self.loadingPlan = LoadingPlan(self)
             
-      # Set up paths -- enumerate *all* network paths, then assign the appropriate ones to each OD pair
-      # Warning: This approach will not scale if you give it a large network.  Use with caution.
+      # Set up paths -- either enumerate *all* network paths from each origin, then assign the appropriate
+      # ones to each OD pair, or start each OD pair with just its free-flow shortest path.
+      # Warning: Enumeration will not scale if you give it a large network.  Use with caution.
       
-      originPaths = list()
-      for i in range(self.numNodes):
-         originPaths.append(self.enumeratePaths(i))
-         
+      originPaths = dict() # keys are origins, values are enumerated paths or free-flow TDSP labels
       for OD in self.ODs:
          validOrigin = type(self.nodes[OD.origin]) is nodeModel.OriginNode
          validDestination = type(self.nodes[OD.destination]) is nodeModel.DestinationNode         
@@ -508,9 +1281,35 @@ class Network:
          if not validDestination: print("Network validation failed: destination %d is not a DestinationNdode" % (OD.destination + 1))
          if not validOrigin or not validDestination: raise utils.BadFileFormatException
       
-         OD.paths = [path for path in originPaths[OD.origin] if self.links[path[-1]].head == OD.destination]
+         if self.generatePaths:
+            if OD.origin not in originPaths: originPaths[OD.origin] = self.TDSP(OD.origin, 0)
+            cost, backlink = originPaths[OD.origin]
+            OD.paths = [self.tracePath(OD.origin, OD.destination, backlink)] if backlink[OD.destination] != NO_PATH else []
+         else:
+            if OD.origin not in originPaths: originPaths[OD.origin] = self.enumeratePaths(OD.origin)
+            OD.paths = [path for path in originPaths[OD.origin] if self.links[path[-1]].head == OD.destination]
          if len(OD.paths) == 0: 
             print("Network not connected: no paths from %d to %d" % (OD.origin, OD.destination))
             raise utils.BadFileFormatException
+
+      # Path flows and travel times are matrices with one row per path
+      for OD in self.ODs:
+         for path in OD.paths:
+            self.pathRegistry.add(path)
+      self.pathFlows = pathMatrix.PathMatrix(self.pathRegistry, self.timeHorizon)
+      self.pathTravelTimes = pathMatrix.PathMatrix(self.pathRegistry, self.timeHorizon, dtype = int)
+
+      # Link counts are kept by path ID, and nodes find where each path turns from the registry
+      for junction in self.nodes:
+         junction.setPathRegistry(self.pathRegistry)
+
+      # Multi-class CTM links split inflows into classes using the shares of the OD pair each path serves
+      self.pathClassShares = dict()
+      for OD in self.ODs:
+         for path in OD.paths:
+            self.pathClassShares[self.pathRegistry.index[path]] = OD.classShares
+      for ij in self.links:
+         if isinstance(self.links[ij], linkModel.CellTransmissionModelLink):
+            self.links[ij].pathClassShares = self.pathClassShares
          
       self.calculatePathTravelTimes()
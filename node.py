@@ -1,3 +1,5 @@
+import numpy
+
 from units import *
 
 class Node:
@@ -5,6 +7,15 @@ class Node:
    def __init__(self, upstreamLinks, downstreamLinks):
       self.upstreamLinks = list(upstreamLinks)
       self.downstreamLinks = list(downstreamLinks)
+      self.pathRegistry = None
+
+   def setPathRegistry(self, pathRegistry):
+      """
+      Gives the node the PathRegistry whose path IDs are used as keys in link counts, so the link each path
+      turns onto can be looked up there.
+      """
+      self.pathRegistry = pathRegistry
+      self.downstreamColumns = [pathRegistry.linkColumn(outLink.ID) for outLink in self.downstreamLinks]
    
    def updateNode(self, t):
       """
@@ -17,7 +28,7 @@ class Node:
          sendingFlow[inLink] = inLink.calculateSendingFlow(t)
       for outLink in self.downstreamLinks:
          receivingFlow[outLink] = outLink.calculateReceivingFlow(t)
-      self.proportion = self.calculateProportions(t)   
+      self.proportion = self.calculateProportions(t, sendingFlow)   
       self.transitionFlows = self.calculateTransitionFlows(sendingFlow, receivingFlow, self.proportion)
       self.moveFlow(t, self.transitionFlows)
          
@@ -34,37 +45,54 @@ class Node:
       This method actually takes care of moving flow from incoming links to outgoing links.  transitionFlows is a dictionary
       of dictionaries; the two keys are the incoming and outgoing links, and the values indicate how many vehicles should move
       between that pair of links during time interval t.  To do this while ensuring FIFO, we need to use the disaggregated
-      version of the sending flows calculated earlier.
+      version of the sending flows calculated earlier, along with the sending flows they were based on.  Paths are identified by
+      their IDs in the path registry, and the link each one turns onto is the one found by calculateProportions.
       """
       linkInflow = dict()
       for outLink in self.downstreamLinks:
          linkInflow[outLink] = dict()
 
       for inLink in self.upstreamLinks:
-         sendingFlow = inLink.calculateSendingFlow(t)
+         sendingFlow = self.sendingFlow[inLink]
+         paths, pathFlows, turns = self.pathTurns[inLink]
+         # Each path on a movement with flow moves the same fraction of its sending flow
+         movementFlow = numpy.array([sendingFlow * self.proportion[inLink][outLink] for outLink in self.downstreamLinks], dtype = float)
+         movementTransitionFlow = numpy.array([transitionFlows[inLink].get(outLink, 0) for outLink in self.downstreamLinks], dtype = float)
+         moving = movementFlow > 0
+         movingFraction = numpy.zeros(len(self.downstreamLinks))
+         movingFraction[moving] = movementTransitionFlow[moving] / movementFlow[moving]
+         
+         moves = turns >= 0
+         moves[moves] = moving[turns[moves]]
+         pathMovingFlow = pathFlows[moves] * movingFraction[turns[moves]]
          linkOutflow = dict()
-         for path in self.disaggregateSendingFlow[inLink]:
-            for outLink in self.downstreamLinks:
-               if outLink.ID in path and sendingFlow * self.proportion[inLink][outLink] > 0:
-                  pathMovingFlow = self.disaggregateSendingFlow[inLink][path] * transitionFlows[inLink][outLink] / (sendingFlow * self.proportion[inLink][outLink])
-                  linkOutflow[path] = pathMovingFlow
-                  linkInflow[outLink][path] = linkInflow[outLink].setdefault(path, 0) + pathMovingFlow
+         for path, b, flow in zip(paths[moves].tolist(), turns[moves].tolist(), pathMovingFlow.tolist()):
+            linkOutflow[path] = flow
+            outLinkInflow = linkInflow[self.downstreamLinks[b]]
+            outLinkInflow[path] = outLinkInflow.get(path, 0) + flow
          inLink.flowOut(linkOutflow)
          
       for outLink in self.downstreamLinks:
          outLink.flowIn(linkInflow[outLink])
 
    
-   def calculateDisaggregateSendingFlows(self, t):
+   def calculateDisaggregateSendingFlows(self, t, sendingFlow = None):
       """
       This method calculates the sending flow for a link, then uses getFlowComposition to see what paths are used by these vehicles.
       Due to discretization, the sending flow vehicles generally do not align exactly with time interval boundaries, so this method
       scales/normalizes these values so that the total number of vehicles in the disaggregateSendingFlow is correct, while the proportions
       match those given by getFlowComposition (which is based on a superset of the time intervals in the sending flow).
+
+      sendingFlow is a dictionary of sending flows for the upstream links, as returned by linkUpdate.  If it is not given, the
+      sending flows are calculated here.  Either way a copy is kept in self.sendingFlow for moveFlow, so each link's sending flow
+      is only found once per time step.
       """
+      if sendingFlow == None:
+         sendingFlow = {inLink : inLink.calculateSendingFlow(t) for inLink in self.upstreamLinks}
+      self.sendingFlow = dict(sendingFlow)
       self.disaggregateSendingFlow = dict()
       for inLink in self.upstreamLinks:
-         sendingFlow = inLink.calculateSendingFlow(t)
+         sendingFlow = self.sendingFlow[inLink]
         
          # Get raw disaggregate sending flows...
          self.disaggregateSendingFlow[inLink] = inLink.getFlowComposition(inLink.getEntryTime(inLink.downstreamCount(t),False), inLink.getEntryTime(inLink.downstreamCount(t) + sendingFlow, True))
@@ -76,33 +104,41 @@ class Node:
                self.disaggregateSendingFlow[inLink][path] *= scaleFactor
             
 
-   # Each path is a tuple of links that includes each link at most once                     
-   def calculateProportions(self, t): 
+   def findPathTurns(self, inLink):
+      """
+      Returns three arrays describing the disaggregate sending flow of an incoming link: the IDs of its paths,
+      their flows, and the position in downstreamLinks of the link each path turns onto (-1 for paths which
+      do not continue through this node).  The turns come from the path registry given to setPathRegistry.
+      """
+      if self.pathRegistry == None:
+         raise ValueError("node has no path registry; call setPathRegistry before loading the network")
+      pathFlows = self.disaggregateSendingFlow[inLink]
+      paths = numpy.fromiter(pathFlows.keys(), dtype = int, count = len(pathFlows))
+      flows = numpy.fromiter(pathFlows.values(), dtype = float, count = len(pathFlows))
+      nextLinks = self.pathRegistry.nextLinks(inLink.ID, paths.tolist())
+      turns = numpy.full(len(paths), -1, dtype = int)
+      for b, column in enumerate(self.downstreamColumns):
+         turns[nextLinks == column] = b
+      return paths, flows, turns
+
+   def calculateProportions(self, t, sendingFlow = None): 
       """
       calculateProportions uses the disaggregateSendingFlows from incoming links to calculate the proportion of the sending flow
       headed for each outgoing link.  It returns a dictionary of dictionaries (proportion) whose keys are the incoming and outgoing
       links, and whose values are the proportion of the sending flow from the incoming link which wants to turn onto the outgoing
-      link.
+      link.  sendingFlow is passed on to calculateDisaggregateSendingFlows.  The turn taken by each path is kept in self.pathTurns
+      for moveFlow.
       """
-      self.calculateDisaggregateSendingFlows(t)
+      self.calculateDisaggregateSendingFlows(t, sendingFlow)
       proportion = dict()
+      self.pathTurns = dict()
       for inLink in self.upstreamLinks:
-         proportion[inLink] = dict()
-         outFlow = dict()
-         for path in self.disaggregateSendingFlow[inLink]:
-            for outLink in self.downstreamLinks:
-               if outLink.ID in path:
-                  proportion[inLink][outLink] = proportion[inLink].setdefault(outLink, 0) + self.disaggregateSendingFlow[inLink][path]
-                  continue
-         totalFlow = float(sum(proportion[inLink].values()))
+         paths, flows, turns = self.pathTurns[inLink] = self.findPathTurns(inLink)
+         turning = turns >= 0
+         outFlow = numpy.bincount(turns[turning], weights = flows[turning], minlength = len(self.downstreamLinks))
+         totalFlow = float(outFlow.sum())
          if (totalFlow > 0):
-            for outLink in self.downstreamLinks:
-               proportion[inLink][outLink] = proportion[inLink].setdefault(outLink, 0) / totalFlow
+            proportion[inLink] = dict(zip(self.downstreamLinks, (outFlow / totalFlow).tolist()))
          else:
-            for outLink in self.downstreamLinks:
-               proportion[inLink][outLink] = 1.0 / (len(self.downstreamLinks))
+            proportion[inLink] = {outLink : 1.0 / (len(self.downstreamLinks)) for outLink in self.downstreamLinks}
       return proportion
-            
-
-      
-
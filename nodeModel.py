@@ -1,4 +1,4 @@
-from copy import copy
+import numpy
 from node import Node
 
 class WrongNodeTypeException(Exception):
@@ -62,35 +62,80 @@ class MergeNode(Node):
          raise WrongNodeTypeException
    
    def calculateTransitionFlows(self, sendingFlow, receivingFlow, proportion):
+      """
+      Divides the receiving flow of the outgoing link among incoming links in proportion to their priorities, with any
+      share an incoming link cannot use going to the others (water-filling).  Taking incoming links in increasing order of
+      sending flow per unit priority, each one is offered its priority share of the receiving flow still available; the
+      links which can send everything they have come first, and once one cannot, neither can any later link, so a single
+      pass gives the final allocation.
+      """
       transitionFlows = dict()   
+      outLink = self.downstreamLinks[0]      
       for inLink in self.upstreamLinks:
          transitionFlows[inLink] = dict()
+         
+      remainingFlow = max(receivingFlow[outLink], 0)
+      remainingPriority = float(sum(self.priority[inLink] for inLink in self.upstreamLinks))
+      for inLink in sorted(self.upstreamLinks, key = lambda inLink: sendingFlow[inLink] / self.priority[inLink]):
+         transitionFlows[inLink][outLink] = min(sendingFlow[inLink], self.priority[inLink] / remainingPriority * remainingFlow)
+         remainingFlow -= transitionFlows[inLink][outLink]
+         remainingPriority -= self.priority[inLink]
       
-      outLink = self.downstreamLinks[0]      
+      return transitionFlows
       
-      for inLink in self.upstreamLinks:
-         transitionFlows[inLink][outLink] = 0
+class GeneralNode(Node):
+   """
+   Node with any number of incoming and outgoing links, using the incremental transfer principle (Tampere et al.).
+   Each incoming link's flow keeps its turning proportions, and receiving flow on an outgoing link is shared by the
+   incoming links using it in proportion to their priority times their turning proportion towards that link.  Flows
+   are found by repeatedly taking the most restrictive outgoing link: incoming links which can send all their flow
+   at its rate are served in full; otherwise all incoming links competing for it are capped at its rate.  Each pass
+   fixes the flows of at least one incoming link, and all calculations are done on arrays over the movements.
+   """
+
+   def __init__(self, upstreamLinks, downstreamLinks, priority):
+      if len(upstreamLinks) < 1 or len(downstreamLinks) < 1:
+         raise WrongNodeTypeException
+      Node.__init__(self, upstreamLinks, downstreamLinks)
+      self.priority = priority
+      if min(priority.values()) <= 0:
+         print("General nodes must have strictly positive priority values for incoming links.")
+         raise WrongNodeTypeException
+      self.priorityArray = numpy.array([priority[inLink] for inLink in self.upstreamLinks], dtype = float)
+
+   def calculateTransitionFlows(self, sendingFlow, receivingFlow, proportion):
+      sending = numpy.array([sendingFlow[inLink] for inLink in self.upstreamLinks], dtype = float)
+      remainingReceivingFlow = numpy.maximum(numpy.array([receivingFlow[outLink] for outLink in self.downstreamLinks], dtype = float), 0)
+      turning = numpy.array([[proportion[inLink].get(outLink, 0) for outLink in self.downstreamLinks]
+                             for inLink in self.upstreamLinks], dtype = float)
+      movementPriority = self.priorityArray[:, None] * turning
+      movementFlow = numpy.zeros(turning.shape)
+      
+      active = sending > 0
+      while active.any():
+         # Flow per unit of priority each outgoing link can give the active incoming links using it
+         used = (turning[active] > 0).any(axis = 0)
+         if not used.any(): break
+         rate = numpy.full(len(self.downstreamLinks), numpy.inf)
+         rate[used] = remainingReceivingFlow[used] / movementPriority[active][:, used].sum(axis = 0)
+         mostRestrictive = rate.argmin()
          
-      activeLinks = copy(self.upstreamLinks)
-      while len(activeLinks) > 0 and receivingFlow[outLink] > 0:
-         totalPriority = 0
-         for inLink in activeLinks:
-            totalPriority += self.priority[inLink]
-         flowMovedThisIteration = 0
-         inactivatedLinks = list()
-         for inLink in activeLinks:
-            additionalFlow = min(sendingFlow[inLink], self.priority[inLink] / float(totalPriority) * receivingFlow[outLink])
-            transitionFlows[inLink][outLink] += additionalFlow
-            flowMovedThisIteration += additionalFlow
-            sendingFlow[inLink] -= additionalFlow
-            if sendingFlow[inLink] == 0: 
-               inactivatedLinks.append(inLink)
-         receivingFlow[outLink] -= flowMovedThisIteration
-         for inLink in inactivatedLinks:
-            activeLinks.remove(inLink)
+         competing = active & (turning[:, mostRestrictive] > 0)
+         demandConstrained = competing & (sending <= rate[mostRestrictive] * self.priorityArray)
+         if demandConstrained.any():
+            finished = demandConstrained
+            movementFlow[finished] = sending[finished, None] * turning[finished]
+         else:
+            finished = competing
+            movementFlow[finished] = rate[mostRestrictive] * movementPriority[finished]
+         remainingReceivingFlow = numpy.maximum(remainingReceivingFlow - movementFlow[finished].sum(axis = 0), 0)
+         active &= ~finished
       
+      transitionFlows = dict()
+      for a, inLink in enumerate(self.upstreamLinks):
+         transitionFlows[inLink] = dict(zip(self.downstreamLinks, movementFlow[a].tolist()))
       return transitionFlows
-      
+
 class OriginNode(Node):
 
    def __init__(self, upstreamLinks, downstreamLinks):
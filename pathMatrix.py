@@ -0,0 +1,111 @@
+import numpy
+
+class PathRegistry:
+   """
+   Assigns each path (a tuple of link IDs) a dense integer ID, in the order the paths are added.  Several
+   PathMatrix objects can share one registry, so that the same row of each matrix refers to the same path
+   and quantities such as total system travel time can be computed with whole-matrix operations.
+
+   The registry also records where each path goes after every link it uses, so that network loading can
+   find where vehicles on a path turn without searching the path.  Each link seen on a path is given a
+   column number, and for each link the registry keeps a dictionary whose keys are the IDs of the paths
+   continuing past it and whose values are the column of the link which follows it on that path.  Only
+   the links a path actually uses are stored.
+   """
+
+   def __init__(self):
+      self.index = dict() # keys are paths, values are integer IDs
+      self.paths = list() # path with each ID
+      self.linkIndex = dict() # keys are link IDs, values are columns
+      self.successors = dict() # keys are link IDs, values are dictionaries mapping path IDs to next link columns
+
+   def __len__(self):
+      return len(self.paths)
+
+   def __contains__(self, path):
+      return path in self.index
+
+   def __iter__(self):
+      return iter(self.paths)
+
+   def add(self, path):
+      """
+      Returns the ID of a path, assigning it the next ID (and recording the link following each of its
+      links) if it has not been seen before.
+      """
+      try:
+         return self.index[path]
+      except KeyError:
+         pathID = len(self.paths)
+         columns = [self.linkColumn(ij) for ij in path]
+         for ij, column in zip(path[:-1], columns[1:]):
+            self.successors.setdefault(ij, dict())[pathID] = column
+         self.index[path] = pathID
+         self.paths.append(path)
+         return pathID
+
+   def linkColumn(self, linkID):
+      """
+      Returns the column used for a link, adding one if the link is new.
+      """
+      try:
+         return self.linkIndex[linkID]
+      except KeyError:
+         self.linkIndex[linkID] = len(self.linkIndex)
+         return self.linkIndex[linkID]
+
+   def nextLinks(self, linkID, pathIDs):
+      """
+      Returns an array with the column of the link following linkID on each of the paths in pathIDs, or -1
+      where the path does not continue from linkID.
+      """
+      successors = self.successors.get(linkID, dict())
+      return numpy.fromiter((successors.get(pathID, -1) for pathID in pathIDs), dtype = int, count = len(pathIDs))
+
+class PathMatrix:
+   """
+   Stores one value per path and departure time in a NumPy matrix with a row for each path in a
+   PathRegistry and a column for each time step.  Indexing with a path returns its row (a NumPy view, so
+   pathMatrix[path][t] can be read and assigned like the dictionary of lists it replaces), and assigning a
+   row to a new path adds that path to the registry.  Rows for paths added to the registry through another
+   matrix start at zero.
+
+   Rows are reallocated as the registry grows, so a row obtained before new paths are added should not be
+   written to afterwards.
+   """
+
+   def __init__(self, registry, timeHorizon, dtype = float):
+      self.registry = registry
+      self.timeHorizon = timeHorizon
+      self.values = numpy.zeros((max(len(registry), 1), timeHorizon), dtype = dtype)
+
+   def __len__(self):
+      return len(self.registry)
+
+   def __contains__(self, path):
+      return path in self.registry
+
+   def __iter__(self):
+      return iter(self.registry)
+
+   def __getitem__(self, path):
+      return self.matrix()[self.registry.index[path]]
+
+   def __setitem__(self, path, values):
+      row = self.registry.add(path)
+      self.matrix()[row] = values
+
+   def keys(self):
+      return list(self.registry.paths)
+
+   def matrix(self):
+      """
+      Returns a view of the matrix with exactly one row per registered path, first growing the
+      underlying storage if paths have been added since the last call.
+      """
+      numPaths = len(self.registry)
+      if numPaths > self.values.shape[0]:
+         grown = numpy.zeros((max(numPaths, 2 * self.values.shape[0]), self.timeHorizon), dtype = self.values.dtype)
+         grown[:self.values.shape[0]] = self.values
+         self.values = grown
+      return self.values[:numPaths]
@@ -0,0 +1,76 @@
+class StepSizeRule:
+   """
+   Base class for the step size used by Network.DTA when combining the current path flows with the
+   all-or-nothing target.  reset is called once at the start of DTA, and stepSize is called once per
+   iteration with the network (whose travel times, SPTT and path flows are current) and that iteration's
+   average excess cost.  Returns a number between 0 and 1.
+   """
+
+   def reset(self):
+      pass
+
+   def stepSize(self, iteration, network, AEC):
+      raise NotImplementedError("%s does not define stepSize" % type(self).__name__)
+
+class MSA(StepSizeRule):
+   """
+   Method of successive averages: the step at iteration k (counting from 0) is 1 / (k + 2), so every
+   all-or-nothing target (including the initial one) has equal weight in the current path flows.
+   """
+
+   def stepSize(self, iteration, network, AEC):
+      return 1.0 / (iteration + 2)
+
+class ConstantStep(StepSizeRule):
+   """
+   The same step in every iteration.
+   """
+
+   def __init__(self, step):
+      self.step = step
+
+   def stepSize(self, iteration, network, AEC):
+      return self.step
+
+class SelfRegulatedAverage(StepSizeRule):
+   """
+   Self-regulated averaging.  The step is 1 / beta, where beta grows by largeIncrement whenever the average
+   excess cost fails to improve on the previous iteration and by the smaller smallIncrement otherwise.  Steps
+   therefore stay large while the assignment is making progress and shrink quickly once it starts to
+   oscillate.  largeIncrement should exceed 1 and smallIncrement should be below 1.
+   """
+
+   def __init__(self, largeIncrement = 1.5, smallIncrement = 0.5):
+      self.largeIncrement = largeIncrement
+      self.smallIncrement = smallIncrement
+      self.reset()
+
+   def reset(self):
+      self.beta = 1.0 # the initial all-or-nothing assignment has step size 1
+      self.previousAEC = None
+
+   def stepSize(self, iteration, network, AEC):
+      if self.previousAEC != None and AEC >= self.previousAEC:
+         self.beta += self.largeIncrement
+      else:
+         self.beta += self.smallIncrement
+      self.previousAEC = AEC
+      return 1.0 / self.beta
+
+class GapBasedStep(StepSizeRule):
+   """
+   Adaptive step proportional to the relative gap (TSTT - SPTT) / TSTT, so that flows move a long way while
+   far from equilibrium and only slightly near it.  The step is scale times the relative gap, capped at
+   maxStep and never smaller than minStep.
+   """
+
+   def __init__(self, scale = 1.0, minStep = 0.01, maxStep = 0.5):
+      self.scale = scale
+      self.minStep = minStep
+      self.maxStep = maxStep
+
+   def stepSize(self, iteration, network, AEC):
+      TSTT = network.calculateTSTT()
+      if TSTT <= 0: return self.minStep
+      relativeGap = AEC * network.totalDemand / TSTT
+      return max(self.minStep, min(self.maxStep, self.scale * relativeGap))
@@ -1,7 +1,13 @@
+import os
 import sys
+import tempfile
 import traceback
 
+import link
+import linkModel
 import network
+import nodeModel
+import stepSize
 import utils
    
 IS_MISSING = -1
@@ -214,3 +220,1006 @@ def convexCombo(testFileName):
       return 0, 0
    
 
+def networkFile(testFileName):
+  
+   print("Running network file test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            networkFile = IS_MISSING
+            expectError = False
+            correctClasses = list()
+            correctShares = list()
+            correctDemand = list()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set network file
+               if networkFile == IS_MISSING:
+                  networkFile = line
+                  continue
+                  
+               inputs = [x.strip() for x in line.split(",")]
+               
+               # Reading the network should fail
+               if inputs[0] == 'ERROR':
+                  expectError = True
+                  continue
+                  
+               # Set correct vehicle classes
+               if inputs[0] == 'CLASS':
+                  correctClasses.append((inputs[1], float(inputs[2]), float(inputs[3])))
+                  continue
+                  
+               # Set correct OD class shares
+               if inputs[0] == 'SHARES':
+                  correctShares.append((int(inputs[1]), int(inputs[2]), [float(x) for x in inputs[3:]]))
+                  continue
+                  
+               # Set correct OD demand
+               if inputs[0] == 'DEMAND':
+                  correctDemand.append((int(inputs[1]), int(inputs[2]), [float(x) for x in inputs[3:]]))
+                  continue
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test
+         try:
+            if expectError:
+               try:
+                  network.Network(networkFile)
+               except utils.BadFileFormatException:
+                  print("...pass")
+                  return pointsPossible, pointsPossible
+               print("\nNetwork file %s was read without error" % networkFile)
+               print("...fail")
+               return 0, pointsPossible
+               
+            testNetwork = network.Network(networkFile)
+            numChecks = 1
+            numCorrect = 1 if checkExact("number of vehicle classes", len(testNetwork.vehicleClasses), len(correctClasses)) else 0
+            for vehicleClass, (name, length, share) in zip(testNetwork.vehicleClasses, correctClasses):
+               numChecks += 3
+               numCorrect += 1 if checkExact("vehicle class name", vehicleClass.name, name) else 0
+               numCorrect += 1 if check("Class %s length" % name, vehicleClass.length, length, 0.01) else 0
+               numCorrect += 1 if check("Class %s share" % name, vehicleClass.share, share, 0.01) else 0
+            ODs = {(OD.origin + 1, OD.destination + 1) : OD for OD in testNetwork.ODs}
+            for origin, destination, shares in correctShares:
+               for c, share in enumerate(shares):
+                  numChecks += 1
+                  numCorrect += 1 if check("OD (%d,%d) share of class %d" % (origin, destination, c), ODs[(origin, destination)].classShares[c], share, 0.01) else 0
+            for origin, destination, demand in correctDemand:
+               demandRates = ODs[(origin, destination)].demandRates
+               name = "OD (%d,%d)" % (origin, destination)
+               numChecks += 3
+               numCorrect += 1 if checkExact(name + " number of demand values", len(demandRates), len(demand)) else 0
+               numCorrect += 1 if checkExact(name + " departure times", demandRates.departureTimes(), [t for t in range(len(demand)) if demand[t] > 0]) else 0
+               numCorrect += 1 if check(name + " total demand", demandRates.total(), sum(demand), 0.01) else 0
+               for t, (rate, denseRate, listedRate) in enumerate(zip(demand, demandRates.dense(), demandRates)):
+                  numChecks += 3
+                  numCorrect += 1 if check(name + " demand at time %d" % t, demandRates[t], rate, 0.01) else 0
+                  numCorrect += 1 if check(name + " dense demand at time %d" % t, denseRate, rate, 0.01) else 0
+                  numCorrect += 1 if check(name + " listed demand at time %d" % t, listedRate, rate, 0.01) else 0
+               numChecks += 1
+               numCorrect += 1 if check(name + " demand at last time", demandRates[-1], demand[-1], 0.01) else 0
+            if len(correctDemand) > 0:
+               numChecks += 1
+               numCorrect += 1 if check("total demand", testNetwork.totalDemand, sum(sum(demand) for origin, destination, demand in correctDemand), 0.01) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < numChecks:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(numChecks)), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+def allDepartureTDSP(testFileName):
+  
+   print("Running all-departure-time TDSP test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            networkFile = IS_MISSING
+            destination = IS_MISSING
+            travelTimes = dict()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set network file
+               if networkFile == IS_MISSING:
+                  networkFile = line
+                  testNetwork = network.Network(networkFile)
+                  continue
+                  
+               # Set destination
+               if destination == IS_MISSING:
+                  destination = int(line) - 1
+                  continue
+                  
+               # Set time-dependent travel times
+               if len(travelTimes) < testNetwork.numLinks:
+                  inputs = line.split(",")
+                  testNetwork.links[inputs[0]].travelTime = [int(x) for x in inputs[1:]]
+                  travelTimes[inputs[0]]  = True
+                  continue
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test, comparing against TDSP from every node at every departure time.  Travel
+         # times after the time horizon stay at their last values, so TDSP is given enough of them to finish.
+         try:
+            arrival, nextLink = testNetwork.allDepartureTDSP(destination)
+            maxTravelTime = sum(max(testNetwork.links[ij].travelTime) for ij in testNetwork.links)
+            for ij in testNetwork.links:
+               travelTime = testNetwork.links[ij].travelTime
+               testNetwork.links[ij].travelTime = travelTime + [travelTime[-1]] * (maxTravelTime + 1)
+            numChecks = 0
+            numCorrect = 0
+            for i in range(testNetwork.numNodes):
+               for t in range(testNetwork.timeHorizon):
+                  (correctCost, backlink) = testNetwork.TDSP(i, t)
+                  numChecks += 1
+                  numCorrect += 1 if check("Node %d arrival time when departing at %d" % (i+1, t), arrival[i][t], correctCost[destination], 0.01) else 0
+                  if i != destination and correctCost[destination] < network.INFINITY:
+                     # The path given by the next link labels should arrive at the same time
+                     pathArrival = t
+                     for ij in testNetwork.followNextLinks(i, t, destination, nextLink):
+                        pathArrival += testNetwork.links[ij].travelTime[pathArrival]
+                     numChecks += 1
+                     numCorrect += 1 if check("Node %d path arrival time when departing at %d" % (i+1, t), pathArrival, correctCost[destination], 0.01) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < numChecks:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(numChecks)), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+def parallelShortestPaths(testFileName):
+  
+   print("Running parallel shortest path test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            networkFile = IS_MISSING
+            numWorkers = IS_MISSING
+            travelTimes = dict()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set network file
+               if networkFile == IS_MISSING:
+                  networkFile = line
+                  testNetwork = network.Network(networkFile)
+                  continue
+                  
+               # Set number of workers
+               if numWorkers == IS_MISSING:
+                  numWorkers = int(line)
+                  continue
+                  
+               # Set time-dependent travel times
+               if len(travelTimes) < testNetwork.numLinks:
+                  inputs = line.split(",")
+                  testNetwork.links[inputs[0]].travelTime = [int(x) for x in inputs[1:]]
+                  travelTimes[inputs[0]]  = True
+                  continue
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test, comparing the all-or-nothing assignment found in parallel with the serial one
+         try:
+            testNetwork.numWorkers = 1
+            correctPathFlows = testNetwork.findAllShortestPaths()
+            correctSPTT = testNetwork.SPTT
+            testNetwork.numWorkers = numWorkers
+            targetPathFlows = testNetwork.findAllShortestPaths()
+            numChecks = 1
+            numCorrect = 1 if check("SPTT", testNetwork.SPTT, correctSPTT, 0.01) else 0
+            for path in correctPathFlows:
+               for t in range(testNetwork.timeHorizon):
+                  numChecks += 1
+                  numCorrect += 1 if check("Path %s flow at time %d" % (path, t), targetPathFlows[path][t], correctPathFlows[path][t], 0.01) else 0
+                  
+            # DTA keeps the same worker pool between searches, so after a search with the old travel times the
+            # workers must pick up new ones
+            testNetwork.startWorkers()
+            try:
+               testNetwork.findAllShortestPaths()
+               for ij in testNetwork.links:
+                  travelTime = testNetwork.links[ij].travelTime
+                  testNetwork.links[ij].travelTime = [min(travelTime)] * len(travelTime)
+               testNetwork.numWorkers = 1
+               correctPathFlows = testNetwork.findAllShortestPaths()
+               testNetwork.numWorkers = numWorkers
+               targetPathFlows = testNetwork.findAllShortestPaths()
+            finally:
+               testNetwork.stopWorkers()
+            for path in correctPathFlows:
+               for t in range(testNetwork.timeHorizon):
+                  numChecks += 1
+                  numCorrect += 1 if check("Path %s flow at time %d with new travel times" % (path, t), targetPathFlows[path][t], correctPathFlows[path][t], 0.01) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < numChecks:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(numChecks)), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+def pathSwapping(testFileName):
+  
+   print("Running path swapping test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            networkFile = IS_MISSING
+            swapRate = IS_MISSING
+            originalPathFlows = dict()
+            pathTravelTimes = dict()
+            correctPathFlows = dict()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set network file
+               if networkFile == IS_MISSING:
+                  networkFile = line
+                  testNetwork = network.Network(networkFile)
+                  continue
+                  
+               # Set swap rate
+               if swapRate == IS_MISSING:
+                  swapRate = float(line)
+                  continue
+                  
+               # Set original path flows
+               if len(originalPathFlows) < sum(len(OD.paths) for OD in testNetwork.ODs):
+                  inputs = line.split(",")
+                  path = tuple(inputs[:-testNetwork.timeHorizon])
+                  flows = inputs[-testNetwork.timeHorizon:]
+                  testNetwork.pathFlows[path] = [float(x) for x in flows]
+                  originalPathFlows[path]  = True
+                  continue
+               
+               # Set path travel times
+               if len(pathTravelTimes) < sum(len(OD.paths) for OD in testNetwork.ODs):
+                  inputs = line.split(",")
+                  path = tuple(inputs[:-testNetwork.timeHorizon])
+                  times = inputs[-testNetwork.timeHorizon:]
+                  testNetwork.pathTravelTimes[path] = [int(x) for x in times]
+                  pathTravelTimes[path] = True
+                  continue
+                                          
+               # Set correct path flows   
+               if len(correctPathFlows) < sum(len(OD.paths) for OD in testNetwork.ODs):
+                  inputs = line.split(",")
+                  path = tuple(inputs[:-testNetwork.timeHorizon])
+                  flows = inputs[-testNetwork.timeHorizon:]
+                  correctPathFlows[path] = [float(x) for x in flows]
+                  continue
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test
+         try:
+            testNetwork.swapPathFlows(swapRate)
+            numCorrect = 0
+            for path in correctPathFlows:
+               for t in range(testNetwork.timeHorizon):
+                  numCorrect += 1 if check("Path %s flow at time %d" % (path, t), testNetwork.pathFlows[path][t], correctPathFlows[path][t], 0.01)  else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < len(correctPathFlows) * testNetwork.timeHorizon:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(len(correctPathFlows) * testNetwork.timeHorizon) ), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+def warmStart(testFileName):
+  
+   print("Running warm start test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            networkFile = IS_MISSING
+            generatePaths = IS_MISSING
+            travelTimes = dict()
+            flowFile = IS_MISSING
+            correctPathFlows = dict()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set network file
+               if networkFile == IS_MISSING:
+                  networkFile = line
+                  continue
+                  
+               # Set path generation
+               if generatePaths == IS_MISSING:
+                  generatePaths = int(line) == 1
+                  testNetwork = network.Network(networkFile, generatePaths)
+                  continue
+                  
+               # Set time-dependent travel times
+               if len(travelTimes) < testNetwork.numLinks:
+                  inputs = line.split(",")
+                  travelTimes[inputs[0]] = [int(x) for x in inputs[1:]]
+                  testNetwork.links[inputs[0]].travelTime = list(travelTimes[inputs[0]])
+                  continue
+                  
+               # Set saved path flow file
+               if flowFile == IS_MISSING:
+                  flowFile = line
+                  continue
+                  
+               # Set correct path flows
+               inputs = line.split(",")
+               path = tuple(inputs[:-testNetwork.timeHorizon])
+               correctPathFlows[path] = [float(x) for x in inputs[-testNetwork.timeHorizon:]]
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test: warm start from the saved file, then save the flows and warm start a new
+         # network from them, which should give back the same flows
+         try:
+            testNetwork.loadPathFlows(flowFile)
+            numChecks = 0
+            numCorrect = 0
+            for path in testNetwork.pathFlows:
+               for t in range(testNetwork.timeHorizon):
+                  numChecks += 1
+                  numCorrect += 1 if check("Path %s flow at time %d" % (path, t), testNetwork.pathFlows[path][t], correctPathFlows[path][t] if path in correctPathFlows else 0, 0.01) else 0
+            for path in correctPathFlows:
+               numChecks += 1
+               numCorrect += 1 if checkExact("Path %s in path set" % (path,), path in testNetwork.pathFlows, True) else 0
+               
+            with tempfile.TemporaryDirectory() as tempDirectory:
+               savedFlowFile = os.path.join(tempDirectory, "flows.txt")
+               testNetwork.savePathFlows(savedFlowFile)
+               roundTripNetwork = network.Network(networkFile, generatePaths)
+               for ij in travelTimes:
+                  roundTripNetwork.links[ij].travelTime = list(travelTimes[ij])
+               roundTripNetwork.loadPathFlows(savedFlowFile)
+            for path in testNetwork.pathFlows:
+               for t in range(testNetwork.timeHorizon):
+                  numChecks += 1
+                  numCorrect += 1 if check("Reloaded path %s flow at time %d" % (path, t), roundTripNetwork.pathFlows[path][t] if path in roundTripNetwork.pathFlows else 0, testNetwork.pathFlows[path][t], 0.01) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < numChecks:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(numChecks)), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+def networkArchive(testFileName):
+  
+   print("Running binary network file test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            networkFile = IS_MISSING
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set network file
+               if networkFile == IS_MISSING:
+                  networkFile = line
+                  testNetwork = network.Network(networkFile)
+                  continue
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test: save the network to a binary file and read it back, then load both networks
+         # with the same path flows, and save and read back the results
+         try:
+            with tempfile.TemporaryDirectory() as tempDirectory:
+               archiveFile = os.path.join(tempDirectory, "network.npz")
+               resultsFile = os.path.join(tempDirectory, "results.npz")
+               testNetwork.saveNetwork(archiveFile)
+               archiveNetwork = network.Network(archiveFile)
+               
+               numChecks = 4
+               numCorrect = 1 if checkExact("number of links", archiveNetwork.numLinks, testNetwork.numLinks) else 0
+               numCorrect += 1 if checkExact("number of nodes", archiveNetwork.numNodes, testNetwork.numNodes) else 0
+               numCorrect += 1 if check("timestep", archiveNetwork.timestep, testNetwork.timestep, 0.01) else 0
+               numCorrect += 1 if checkExact("time horizon", archiveNetwork.timeHorizon, testNetwork.timeHorizon) else 0
+               for vehicleClass, correctClass in zip(archiveNetwork.vehicleClasses, testNetwork.vehicleClasses):
+                  numChecks += 3
+                  numCorrect += 1 if checkExact("vehicle class name", vehicleClass.name, correctClass.name) else 0
+                  numCorrect += 1 if check("Class %s length" % correctClass.name, vehicleClass.length, correctClass.length, 0.01) else 0
+                  numCorrect += 1 if check("Class %s share" % correctClass.name, vehicleClass.share, correctClass.share, 0.01) else 0
+               for ij in testNetwork.links:
+                  numChecks += 5
+                  numCorrect += 1 if checkExact("Link %s type" % ij, type(archiveNetwork.links[ij]), type(testNetwork.links[ij])) else 0
+                  numCorrect += 1 if checkExact("Link %s tail" % ij, archiveNetwork.links[ij].tail, testNetwork.links[ij].tail) else 0
+                  numCorrect += 1 if checkExact("Link %s head" % ij, archiveNetwork.links[ij].head, testNetwork.links[ij].head) else 0
+                  numCorrect += 1 if check("Link %s capacity" % ij, archiveNetwork.links[ij].capacity, testNetwork.links[ij].capacity, 0.01) else 0
+                  numCorrect += 1 if check("Link %s priority" % ij, archiveNetwork.linkPriorities[ij], testNetwork.linkPriorities[ij], 0.01) else 0
+               numChecks += 1
+               numCorrect += 1 if checkExact("number of OD pairs", len(archiveNetwork.ODs), len(testNetwork.ODs)) else 0
+               for OD, correctOD in zip(archiveNetwork.ODs, testNetwork.ODs):
+                  name = "OD (%d,%d)" % (correctOD.origin + 1, correctOD.destination + 1)
+                  numChecks += 2
+                  numCorrect += 1 if checkExact(name + " origin", OD.origin, correctOD.origin) else 0
+                  numCorrect += 1 if checkExact(name + " destination", OD.destination, correctOD.destination) else 0
+                  for t in range(testNetwork.timeHorizon):
+                     numChecks += 1
+                     numCorrect += 1 if check(name + " demand at time %d" % t, OD.demandRates[t], correctOD.demandRates[t], 0.01) else 0
+                  for c in range(len(correctOD.classShares)):
+                     numChecks += 1
+                     numCorrect += 1 if check(name + " share of class %d" % c, OD.classShares[c], correctOD.classShares[c], 0.01) else 0
+               
+               testNetwork.initializePathFlows()
+               for path in testNetwork.pathFlows:
+                  archiveNetwork.pathFlows[path] = testNetwork.pathFlows[path]
+               for loadedNetwork in (testNetwork, archiveNetwork):
+                  loadedNetwork.loadNetwork()
+                  loadedNetwork.calculateTravelTimes()
+               for ij in testNetwork.links:
+                  for t in range(testNetwork.timeHorizon):
+                     numChecks += 1
+                     numCorrect += 1 if check("Link %s downstream count at time %d" % (ij, t), archiveNetwork.links[ij].downstreamCount(t), testNetwork.links[ij].downstreamCount(t), 0.01) else 0
+               
+               archiveNetwork.saveResults(resultsFile)
+               results = network.loadResults(resultsFile)
+            for row, ij in enumerate(results['linkIDs']):
+               ij = str(ij)
+               for t in range(testNetwork.timeHorizon):
+                  numChecks += 3
+                  numCorrect += 1 if check("Saved link %s upstream count at time %d" % (ij, t), results['upstreamCounts'][row][t], archiveNetwork.links[ij].upstreamCount(t), 0.01) else 0
+                  numCorrect += 1 if check("Saved link %s downstream count at time %d" % (ij, t), results['downstreamCounts'][row][t], archiveNetwork.links[ij].downstreamCount(t), 0.01) else 0
+                  numCorrect += 1 if checkExact("Saved link %s travel time at time %d" % (ij, t), results['travelTimes'][row][t], archiveNetwork.links[ij].travelTime[t]) else 0
+            for row, path in enumerate(results['paths']):
+               path = tuple(str(path).split(","))
+               for t in range(testNetwork.timeHorizon):
+                  numChecks += 2
+                  numCorrect += 1 if check("Saved path %s flow at time %d" % (path, t), results['pathFlows'][row][t], archiveNetwork.pathFlows[path][t], 0.01) else 0
+                  numCorrect += 1 if checkExact("Saved path %s travel time at time %d" % (path, t), results['pathTravelTimes'][row][t], archiveNetwork.pathTravelTimes[path][t]) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < numChecks:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(numChecks)), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+def nodeTransitionFlows(testFileName):
+  
+   print("Running node model test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            nodeType = IS_MISSING
+            upstreamLinks = list()
+            downstreamLinks = list()
+            sendingFlow = dict()
+            receivingFlow = dict()
+            priority = dict()
+            proportion = dict()
+            correctTransitionFlows = list()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set node type
+               if nodeType == IS_MISSING:
+                  nodeType = line.strip()
+                  continue
+                  
+               inputs = [x.strip() for x in line.split(",")]
+               
+               # Set incoming link sending flows, priorities and turning proportions
+               if inputs[0] == 'IN':
+                  inLink = link.Link(1, 60, 30, 200, 88, 3600, inputs[1])
+                  upstreamLinks.append(inLink)
+                  sendingFlow[inLink] = float(inputs[2])
+                  priority[inLink] = float(inputs[3])
+                  proportion[inLink] = [float(x) for x in inputs[4:]]
+                  continue
+                  
+               # Set outgoing link receiving flows
+               if inputs[0] == 'OUT':
+                  outLink = link.Link(1, 60, 30, 200, 88, 3600, inputs[1])
+                  downstreamLinks.append(outLink)
+                  receivingFlow[outLink] = float(inputs[2])
+                  continue
+                  
+               # Set correct transition flows
+               if inputs[0] == 'FLOW':
+                  correctTransitionFlows.append((inputs[1], inputs[2], float(inputs[3])))
+                  continue
+                  
+            # Turning proportions are listed in the order of the outgoing links
+            for inLink in upstreamLinks:
+               proportion[inLink] = dict(zip(downstreamLinks, proportion[inLink]))
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test
+         try:
+            if   nodeType == 'SERIES':  testNode = nodeModel.SeriesNode(upstreamLinks, downstreamLinks)
+            elif nodeType == 'DIVERGE': testNode = nodeModel.DivergeNode(upstreamLinks, downstreamLinks)
+            elif nodeType == 'MERGE':   testNode = nodeModel.MergeNode(upstreamLinks, downstreamLinks, priority)
+            elif nodeType == 'GENERAL': testNode = nodeModel.GeneralNode(upstreamLinks, downstreamLinks, priority)
+            else:
+               print("\nUnknown node type %s" % nodeType)
+               raise utils.BadFileFormatException
+            transitionFlows = testNode.calculateTransitionFlows(sendingFlow, receivingFlow, proportion)
+            links = {nodeLink.ID : nodeLink for nodeLink in upstreamLinks + downstreamLinks}
+            numCorrect = 0
+            for inLink, outLink, flow in correctTransitionFlows:
+               numCorrect += 1 if check("Transition flow from %s to %s" % (inLink, outLink), transitionFlows[links[inLink]].get(links[outLink], 0), flow, 0.01) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < len(correctTransitionFlows):               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(len(correctTransitionFlows))), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+   
+
+def networkLoading(testFileName):
+  
+   print("Running network loading test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            networkFile = IS_MISSING
+            batched = False
+            nodeTypes = dict()
+            pathFlows = dict()
+            correctCounts = list()
+            correctCells = list()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               # Set network file
+               if networkFile == IS_MISSING:
+                  networkFile = line
+                  testNetwork = network.Network(networkFile)
+                  continue
+                  
+               inputs = [x.strip() for x in line.split(",")]
+               
+               # Compare batched CTM updates with updating each link separately
+               if inputs[0] == 'BATCH':
+                  batched = True
+                  continue
+                  
+               # Set expected node types
+               if inputs[0] == 'NODE':
+                  nodeTypes[int(inputs[1])] = inputs[2]
+                  continue
+                  
+               # Set path flows
+               if inputs[0] == 'PATH':
+                  path = tuple(inputs[1:-testNetwork.timeHorizon])
+                  pathFlows[path] = [float(x) for x in inputs[-testNetwork.timeHorizon:]]
+                  continue
+                  
+               # Set correct cumulative counts
+               if inputs[0] in ('UPSTREAM', 'DOWNSTREAM'):
+                  correctCounts.append((inputs[0], inputs[1], [float(x) for x in inputs[2:]]))
+                  continue
+                  
+               # Set correct CTM cell contents (one value per vehicle class) and derived parameters
+               if inputs[0] == 'CELL':
+                  correctCells.append((inputs[1], int(inputs[2]), [float(x) for x in inputs[3:-2]], float(inputs[-2]), float(inputs[-1])))
+                  continue
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test
+         try:
+            nodeClasses = { 'SERIES' : nodeModel.SeriesNode, 'DIVERGE' : nodeModel.DivergeNode, 
+                            'MERGE' : nodeModel.MergeNode, 'GENERAL' : nodeModel.GeneralNode }
+            numChecks = 0
+            numCorrect = 0
+            for nodeID in nodeTypes:
+               numChecks += 1
+               numCorrect += 1 if checkExact("Node %d type" % nodeID, type(testNetwork.nodes[nodeID - 1]), nodeClasses[nodeTypes[nodeID]]) else 0
+               
+            for path in pathFlows:
+               testNetwork.pathFlows[path] = pathFlows[path]
+            testNetwork.loadNetwork()
+            
+            # Batched CTM updates should give the same counts as updating links one at a time, including
+            # when the network is loaded a second time and the cells have to be emptied first
+            if batched:
+               separateCounts = {ij : ([testNetwork.links[ij].upstreamCount(t) for t in range(testNetwork.timeHorizon + 1)],
+                                       [testNetwork.links[ij].downstreamCount(t) for t in range(testNetwork.timeHorizon + 1)])
+                                 for ij in testNetwork.links}
+               testNetwork.batchCellUpdate = True
+               for loading in range(2):
+                  testNetwork.loadNetwork()
+                  for ij in testNetwork.links:
+                     upstreamCounts, downstreamCounts = separateCounts[ij]
+                     for t in range(testNetwork.timeHorizon + 1):
+                        numChecks += 2
+                        numCorrect += 1 if check("Batched upstream count on link %s at time %d (loading %d)" % (ij, t, loading + 1), testNetwork.links[ij].upstreamCount(t), upstreamCounts[t], 0.0001) else 0
+                        numCorrect += 1 if check("Batched downstream count on link %s at time %d (loading %d)" % (ij, t, loading + 1), testNetwork.links[ij].downstreamCount(t), downstreamCounts[t], 0.0001) else 0
+            for end, ij, counts in correctCounts:
+               countLink = testNetwork.links[ij]
+               for t in range(len(counts)):
+                  count = countLink.upstreamCount(t) if end == 'UPSTREAM' else countLink.downstreamCount(t)
+                  numChecks += 1
+                  numCorrect += 1 if check("%s count on link %s at time %d" % (end.lower().capitalize(), ij, t), count, counts[t], 0.01) else 0
+                  
+            # Vehicles still in the cells of a CTM link are the ones which entered and have not left
+            for ij in testNetwork.links:
+               cellLink = testNetwork.links[ij]
+               if isinstance(cellLink, linkModel.CellTransmissionModelLink):
+                  numChecks += 1
+                  numCorrect += 1 if check("Vehicles in the cells of link %s" % ij, cellLink.cells.totalVehicles().sum(), cellLink.upstreamCount(testNetwork.timeHorizon) - cellLink.downstreamCount(testNetwork.timeHorizon), 0.0001) else 0
+                  
+            # Cell parameters are derived from the class mix at the end of loading
+            for ij, k, vehicles, capacity, maxVehicles in correctCells:
+               cells = testNetwork.links[ij].cells
+               cells.updateParameters()
+               for c in range(len(vehicles)):
+                  numChecks += 1
+                  numCorrect += 1 if check("Class %d vehicles in cell %d of link %s" % (c, k, ij), cells.vehicles[k][c], vehicles[c], 0.0001) else 0
+               numChecks += 2
+               numCorrect += 1 if check("Capacity of cell %d of link %s" % (k, ij), cells.capacity[k], capacity, 0.0001) else 0
+               numCorrect += 1 if check("Maximum vehicles in cell %d of link %s" % (k, ij), cells.maxVehicles[k], maxVehicles, 0.0001) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < numChecks:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(numChecks)), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0
+   
+
+class FixedGapNetwork:
+   """
+   Stands in for a Network when testing step size rules, with a fixed TSTT and total demand.
+   """
+   def __init__(self, TSTT, totalDemand):
+      self.TSTT = TSTT
+      self.totalDemand = totalDemand
+
+   def calculateTSTT(self):
+      return self.TSTT
+   
+
+def stepSizeRule(testFileName):
+  
+   print("Running step size test: " + str(testFileName) + "...", end='')
+   
+   try:
+      with open(testFileName, "r") as testFile:
+         # Read test information
+         try:
+            fileLines = testFile.read().splitlines()
+            pointsPossible = IS_MISSING
+            rule = IS_MISSING
+            steps = list()
+            DTAFile = IS_MISSING
+            correctPathFlows = dict()
+            for line in fileLines:
+               # Ignore comments and blank lines
+               if len(line.strip()) == 0 or line[0] == '#':
+                  continue
+                   
+               # Set points possible
+               if pointsPossible == IS_MISSING:
+                  pointsPossible = int(line)
+                  continue
+                  
+               inputs = [x.strip() for x in line.split(",")]
+               
+               # Set step size rule
+               if rule == IS_MISSING:
+                  parameters = [float(x) for x in inputs[1:]]
+                  if   inputs[0] == 'BASE':           rule = stepSize.StepSizeRule()
+                  elif inputs[0] == 'MSA':            rule = stepSize.MSA()
+                  elif inputs[0] == 'CONSTANT':       rule = stepSize.ConstantStep(*parameters)
+                  elif inputs[0] == 'SELF-REGULATED': rule = stepSize.SelfRegulatedAverage(*parameters)
+                  elif inputs[0] == 'GAP':            rule = stepSize.GapBasedStep(*parameters)
+                  else:
+                     print("\nUnknown step size rule %s" % inputs[0])
+                     raise utils.BadFileFormatException
+                  continue
+                  
+               # Set average excess cost, TSTT and total demand for each step, with the correct step size
+               # (ERROR if the rule should refuse to give one), or RESET to start the rule again
+               if inputs[0] == 'STEP':
+                  steps.append((float(inputs[1]), float(inputs[2]), float(inputs[3]), inputs[4]))
+                  continue
+               if inputs[0] == 'RESET':
+                  steps.append(None)
+                  continue
+                  
+               # Set network file and number of iterations for a DTA run using the rule
+               if inputs[0] == 'DTA':
+                  DTAFile = inputs[1]
+                  numIterations = int(inputs[2])
+                  testNetwork = network.Network(DTAFile)
+                  continue
+                  
+               # Set correct path flows after the DTA run
+               if inputs[0] == 'PATH':
+                  path = tuple(inputs[1:-testNetwork.timeHorizon])
+                  correctPathFlows[path] = [float(x) for x in inputs[-testNetwork.timeHorizon:]]
+                  continue
+                  
+         except:
+            print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+            traceback.print_exc(file=sys.stdout)
+            return 0, 0
+            
+         # Now run the actual test
+         try:
+            numChecks = 0
+            numCorrect = 0
+            rule.reset()
+            iteration = 0
+            for step in steps:
+               if step == None:
+                  rule.reset()
+                  iteration = 0
+                  continue
+               AEC, TSTT, totalDemand, correctStep = step
+               numChecks += 1
+               if correctStep == 'ERROR':
+                  try:
+                     rule.stepSize(iteration, FixedGapNetwork(TSTT, totalDemand), AEC)
+                     print("\nStep size at iteration %d should raise NotImplementedError" % iteration)
+                  except NotImplementedError:
+                     numCorrect += 1
+               else:
+                  numCorrect += 1 if check("Step size at iteration %d" % iteration, rule.stepSize(iteration, FixedGapNetwork(TSTT, totalDemand), AEC), float(correctStep), 0.0001) else 0
+               iteration += 1
+               
+            # A DTA run which never reaches its target gap applies the rule in every iteration
+            if DTAFile != IS_MISSING:
+               testNetwork.DTA(numIterations, 0, rule)
+               for path in correctPathFlows:
+                  for t in range(testNetwork.timeHorizon):
+                     numChecks += 1
+                     numCorrect += 1 if check("Path %s flow at time %d" % (path, t), testNetwork.pathFlows[path][t], correctPathFlows[path][t], 0.0001) else 0
+         except utils.NotYetAttemptedException:
+            print("...not yet attempted")
+            return 0, pointsPossible
+         except:
+            print("\nException raised, attempting to continue:")
+            traceback.print_exc(file=sys.stdout)                     
+            print("\n...fail")
+            return 0, pointsPossible
+
+         if numCorrect < numChecks:               
+            print("...fail")
+         else:            
+            print("...pass")
+         return pointsPossible * (numCorrect / float(numChecks)), pointsPossible
+
+         
+   except IOError:
+      print("\nError running test %s, attempting to continue with remaining tests.  Exception details: " % testFileName)
+      traceback.print_exc(file=sys.stdout) 
+      return 0, 0